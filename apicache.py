@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import zlib
+import logging
+import sqlite3
+import threading
+import contextvars
+from collections import OrderedDict
+
+import localstore
+
+logger = logging.getLogger(__name__)
+
+# Opt-in cache in front of wadata.call_api. WA_API_CACHE selects the backend:
+# "off" (default), "memory" (per process) or "sqlite" (shared by all workers
+# through the local data directory). Entries are stored compressed, expire
+# after a per-category TTL and are evicted least-recently-used once the total
+# size passes WA_API_CACHE_MAX_BYTES.
+BACKEND = os.environ.get("WA_API_CACHE", "off").lower()
+DEFAULT_TTL = int(os.environ.get("WA_API_CACHE_TTL", 300))  # seconds
+MAX_BYTES = int(os.environ.get("WA_API_CACHE_MAX_BYTES", 64 * 1000 * 1000))
+
+
+def _parse_ttls(value):
+    """Parse "Contacts=600,Events=120" into a dict of per-category TTLs."""
+    ttls = {}
+    for item in value.split(","):
+        if "=" in item:
+            category, ttl = item.split("=", 1)
+            ttls[category.strip()] = int(ttl)
+    return ttls
+
+
+CATEGORY_TTLS = _parse_ttls(os.environ.get("WA_API_CACHE_TTLS", ""))
+
+# Set for a report run the user asked to recompute: every lookup misses, so
+# the run reads from the API, and what it reads is still cached for others.
+refreshing = contextvars.ContextVar("apicache_refreshing", default=False)
+
+
+def ttl_for(category):
+    return CATEGORY_TTLS.get(category, DEFAULT_TTL)
+
+
+def make_key(category, filter_string=None, select_string=None, event_id=None, asynchronous=False, fields=None):
+    return json.dumps([category, filter_string, select_string, event_id, asynchronous,
+                       sorted(fields) if fields else None])
+
+
+def _encode(data):
+    return zlib.compress(json.dumps(data).encode("utf-8"), 1)
+
+
+def _decode(blob):
+    return json.loads(zlib.decompress(blob))
+
+
+class MemoryCache:
+    """Thread-safe LRU cache with per-entry expiry and a total size cap."""
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (category, expires_at, blob)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def put(self, key, category, blob, ttl):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if len(blob) > self.max_bytes:
+                return
+            self._entries[key] = (category, time.time() + ttl, blob)
+            self._size += len(blob)
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, category=None):
+        with self._lock:
+            for key in [k for k, v in self._entries.items() if category is None or v[0] == category]:
+                self._remove(key)
+
+    def _remove(self, key):
+        self._size -= len(self._entries.pop(key)[2])
+
+
+class SQLiteCache:
+    """The same cache kept in a SQLite file so that all worker processes share it."""
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = localstore.connect("apicache.sqlite3")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, category TEXT, "
+            "expires_at REAL, last_used REAL, size INTEGER, value BLOB)"
+        )
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM cache WHERE key = ? AND expires_at >= ?", (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE cache SET last_used = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def put(self, key, category, blob, ttl):
+        if len(blob) > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM cache WHERE expires_at < ?", (now,))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, category, now + ttl, now, len(blob), blob),
+                )
+                total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+                if total > self.max_bytes:
+                    # Drop least recently used entries until we are back under the cap
+                    rows = self._conn.execute("SELECT key, size FROM cache ORDER BY last_used").fetchall()
+                    for old_key, size in rows:
+                        if total <= self.max_bytes:
+                            break
+                        self._conn.execute("DELETE FROM cache WHERE key = ?", (old_key,))
+                        total -= size
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def invalidate(self, category=None):
+        with self._lock:
+            if category is None:
+                self._conn.execute("DELETE FROM cache")
+            else:
+                self._conn.execute("DELETE FROM cache WHERE category = ?", (category,))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Return the configured cache backend, or None when caching is off."""
+    global _cache, BACKEND
+    with _cache_lock:
+        if _cache is None and BACKEND != "off":
+            if BACKEND == "sqlite":
+                try:
+                    _cache = SQLiteCache()
+                except (sqlite3.Error, OSError) as e:
+                    logger.warning(f"Unable to open SQLite API cache, using memory instead: {e}")
+                    _cache = MemoryCache()
+            elif BACKEND == "memory":
+                _cache = MemoryCache()
+            else:
+                logger.warning(f"Unknown WA_API_CACHE backend {BACKEND}, caching is off.")
+                BACKEND = "off"
+        return _cache
+
+
+def get(category, key):
+    """Return the cached data for key, or None on a miss."""
+    cache = get_cache()
+    if cache is None or refreshing.get():
+        return None
+    blob = cache.get(key)
+    if blob is None:
+        logger.debug(f"API cache miss for {category}")
+        return None
+    logger.debug(f"API cache hit for {category}")
+    return _decode(blob)
+
+
+def put(category, key, data):
+    cache = get_cache()
+    if cache is not None and ttl_for(category) > 0:
+        cache.put(key, category, _encode(data), ttl_for(category))
+
+
+def invalidate(category=None):
+    """Drop cached responses for one category, or everything."""
+    cache = get_cache()
+    if cache is not None:
+        cache.invalidate(category)
+        logger.info(f"API cache invalidated for {category or 'all categories'}")
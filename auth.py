@@ -1,20 +1,28 @@
-from flask import Blueprint, session, request, redirect, url_for, render_template, current_app
+from flask import Blueprint, session, request, redirect, url_for, render_template, current_app, has_request_context
+import click
 import requests
 from requests_oauthlib import OAuth2Session
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 import os
 import logging
+import threading
+import time
 import base64
-import json
+import ratelimit
+import localstore
+import metrics
 
 logger = logging.getLogger(__name__)
 
 auth_blueprint = Blueprint('auth', __name__)
 
-# Wild Apricot credentials, secrets are in environment variables
-WA_REPORTING_CLIENT_SECRET = os.environ['WA_REPORTING_CLIENT_SECRET']
-WA_REPORTING_API_KEY = os.environ['WA_REPORTING_API_KEY']
-WA_API_PREFIX = "https://api.wildapricot.org/v2.2/Accounts/335649"
+# Wild Apricot credentials, secrets are in environment variables. They are
+# read when used, not at import (see __getattr__ below), so the app can be
+# imported by tests, CLI commands and a gunicorn --preload parent without them.
+REQUIRED_SETTINGS = ('WA_REPORTING_CLIENT_SECRET', 'WA_REPORTING_API_KEY', 'WA_REPORTING_DOMAIN')
+# Overridable so benchmarks can run against a mock server (see benchmarks/mockwa.py)
+WA_API_PREFIX = os.environ.get("WA_API_PREFIX", "https://api.wildapricot.org/v2.2/Accounts/335649")
 '''
 note that WA_REPORTING_DOMAIN must:
 1. Support HTTPS
@@ -27,14 +35,50 @@ your free static domain name.
 
 Using localhost? See the notes in the README -- you can't use the login button.
 '''
-WA_REPORTING_DOMAIN = os.environ['WA_REPORTING_DOMAIN']
 
 WILD_APRICOT_CLIENT_ID = "jz0nsf5dl4"
-WILD_APRICOT_REDIRECT_URI = f"https://{WA_REPORTING_DOMAIN}/callback"
+
+
+def _setting(name):
+    if name == 'WILD_APRICOT_REDIRECT_URI':
+        return f"https://{_setting('WA_REPORTING_DOMAIN')}/callback"
+    return os.environ[name]
+
+
+def __getattr__(name):
+    # auth.WA_REPORTING_DOMAIN etc. read the environment on each access
+    if name in REQUIRED_SETTINGS or name == 'WILD_APRICOT_REDIRECT_URI':
+        return _setting(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def missing_settings():
+    """Return the names of the required environment variables that are not set."""
+    return [name for name in REQUIRED_SETTINGS if not os.environ.get(name)]
+
+
+# API calls share one keep-alive HTTP session per process so that report
+# fan-outs reuse TCP/TLS connections instead of handshaking on every call.
+# The pool should be at least as large as WA_API_MAX_WORKERS.
+WA_API_POOL_SIZE = int(os.environ.get("WA_API_POOL_SIZE", 10))
+_api_session = None
+_api_session_lock = threading.Lock()
+
+# The client-credentials API token is application-wide, not per user. It is
+# cached in process (and optionally in the local store, so all workers on the
+# host share it) and refreshed a little before it expires. Refreshes are
+# serialized so concurrent callers wait for one request instead of each
+# posting their own.
+WA_API_TOKEN_URL = os.environ.get("WA_API_TOKEN_URL", "https://oauth.wildapricot.org/auth/token")
+WA_API_TOKEN_REFRESH_MARGIN = int(os.environ.get("WA_API_TOKEN_REFRESH_MARGIN", 120))  # seconds
+WA_API_TOKEN_SHARED = os.environ.get("WA_API_TOKEN_SHARED", "false").lower() in ("1", "true", "yes", "on")
+_api_token = None
+_api_token_lock = threading.Lock()
+_api_token_store = None
 
 @auth_blueprint.route("/")
 def index():
-    if current_app.config["ALLOW_LOCALHOST"] == True and WA_REPORTING_DOMAIN == "localhost" and request.remote_addr == '127.0.0.1':            
+    if current_app.config["ALLOW_LOCALHOST"] == True and _setting('WA_REPORTING_DOMAIN') == "localhost" and request.remote_addr == '127.0.0.1':            
         session["allow_localhost"] = True            
     return render_template("index.jinja")
 
@@ -42,7 +86,7 @@ def index():
 def login():
     # Redirect user to Wild Apricot for login
     wild_apricot = OAuth2Session(WILD_APRICOT_CLIENT_ID, 
-                                 redirect_uri=WILD_APRICOT_REDIRECT_URI,
+                                 redirect_uri=_setting('WILD_APRICOT_REDIRECT_URI'),
                                  scope=["contacts_me"])
     authorization_url, state = wild_apricot.authorization_url("https://novalabs.wildapricot.org/sys/login/OAuthLogin")
     logger.debug(f"Initial login complete, redirecting to {authorization_url}")
@@ -55,9 +99,9 @@ def callback():
     if authorization_code == None:
         return "Authorization code not received in callback. Please login again."
     wild_apricot = OAuth2Session(WILD_APRICOT_CLIENT_ID, 
-                                 redirect_uri=WILD_APRICOT_REDIRECT_URI)
+                                 redirect_uri=_setting('WILD_APRICOT_REDIRECT_URI'))
     token = wild_apricot.fetch_token("https://oauth.wildapricot.org/auth/token", 
-                                     client_secret=WA_REPORTING_CLIENT_SECRET,                                     
+                                     client_secret=_setting('WA_REPORTING_CLIENT_SECRET'),                                     
                                      code=authorization_code,                                     
                                      scope=["contacts_me"])
     
@@ -67,93 +111,230 @@ def callback():
         # Store the token in the session
         session['user_token'] = token
         logger.debug(f"User token stored in session.")
-        refresh_token()
         return redirect(url_for('reports.index'))
     else:
         logger.warning(f"User token not received. Login error?")
         return "User login token not received. Please try again."
 
-def refresh_token():
-    # The URL for API tokens
-    api_token_url = "https://oauth.wildapricot.org/auth/token"
+def _fetch_api_token():
     data = {
         "grant_type": "client_credentials",
         "scope": "auto"
     }
     # Send a POST request with Basic Authorization and form data
-    response = requests.post(api_token_url, auth=HTTPBasicAuth("APIKEY", WA_REPORTING_API_KEY), data=data)
-
-    # Check if the request was successful
-    if response.status_code == 200:
-        api_token = response.json().get('access_token')
-        # Store the API token in the session
-        session['api_token'] = api_token
-        logger.debug(f"API token stored in session.")
-    else:
+    response = requests.post(WA_API_TOKEN_URL, auth=HTTPBasicAuth("APIKEY", _setting('WA_REPORTING_API_KEY')), data=data)
+
+    if response.status_code != 200:
+        raise Exception(f"Error getting API token, response code was {response.status_code}.")
+
+    token = response.json()
+    logger.debug(f"API token received, expires in {token.get('expires_in')} seconds.")
+    # Without an expiry, assume the token is good for a few minutes
+    return {
+        'access_token': token.get('access_token'),
+        'expires_at': time.time() + int(token.get('expires_in', 300)),
+    }
+
+
+def _token_is_fresh(token):
+    return token is not None and token['expires_at'] - WA_API_TOKEN_REFRESH_MARGIN > time.time()
+
+
+def _get_token_store():
+    global _api_token_store
+    if _api_token_store is None:
+        _api_token_store = localstore.connect("auth.sqlite3")
+        _api_token_store.execute(
+            "CREATE TABLE IF NOT EXISTS api_token (id INTEGER PRIMARY KEY CHECK (id = 1), "
+            "access_token TEXT, expires_at REAL)"
+        )
+    return _api_token_store
+
+
+def get_api_token(refresh=False, stale_token=None):
+    """Return a valid API access token, fetching a new one when needed.
+
+    With refresh=True a new token is fetched, unless stale_token is given and
+    another thread or worker has already replaced it.
+    """
+    global _api_token
+    with _api_token_lock:
+        def needs_refresh(token):
+            if refresh and (stale_token is None or (token and token['access_token'] == stale_token)):
+                return True
+            return not _token_is_fresh(token)
+
+        if not needs_refresh(_api_token):
+            return _api_token['access_token']
+
+        if not WA_API_TOKEN_SHARED:
+            _api_token = _fetch_api_token()
+            logger.debug(f"API token refreshed.")
+            return _api_token['access_token']
+
+        # Hold the store's write lock while refreshing so that only one
+        # worker process posts for a new token.
+        store = _get_token_store()
+        store.execute("BEGIN IMMEDIATE")
+        try:
+            row = store.execute("SELECT access_token, expires_at FROM api_token WHERE id = 1").fetchone()
+            shared_token = {'access_token': row[0], 'expires_at': row[1]} if row else None
+            if needs_refresh(shared_token):
+                shared_token = _fetch_api_token()
+                store.execute("INSERT OR REPLACE INTO api_token VALUES (1, ?, ?)",
+                              (shared_token['access_token'], shared_token['expires_at']))
+                logger.debug(f"API token refreshed and shared.")
+            store.execute("COMMIT")
+        except BaseException:
+            store.execute("ROLLBACK")
+            raise
+        _api_token = shared_token
+        return _api_token['access_token']
+
+
+def refresh_token(stale_token=None):
+    """Force a new API token. Returns an error message string on failure."""
+    try:
+        get_api_token(refresh=True, stale_token=stale_token)
+    except Exception as e:
+        logger.warning(f"{e}")
         # Handle the error, force user logout
-        session.clear()        
-        return f"Error getting API token, response code was {response.status_code}. Please try again."
+        if has_request_context():
+            session.clear()
+        return f"{e} Please try again."
 
 @auth_blueprint.route("/logout")
 def logout():
+    # Logging out and back in rechecks the user's signoffs
+    if 'contact_id' in session:
+        invalidate_report_access(session['contact_id'])
     session.clear()
     return index()
 
 def get_oauth_session():
-    if 'api_token' not in session:
-        refresh_token()
+    global _api_session
 
     # Bearer token
     token = {
-        'access_token': session['api_token'], 
+        'access_token': get_api_token(),
         'token_type': 'Bearer'
     }
-    oauth_session = OAuth2Session(token=token)
-    return oauth_session
+    with _api_session_lock:
+        if _api_session is None:
+            _api_session = OAuth2Session(token=token)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=WA_API_POOL_SIZE)
+            _api_session.mount("https://", adapter)
+            logger.debug(f"Created pooled API session with pool size {WA_API_POOL_SIZE}.")
+        elif _api_session.token.get('access_token') != token['access_token']:
+            # Token rotated: swap it in place and keep the open connections
+            _api_session.token = token
+            logger.debug(f"API session token updated.")
+    return _api_session
+
+# Report access decisions are cached per contact in the local store, so every
+# worker shares them and a new session usually costs no signoff lookup at all.
+# `flask --app wareporting access-invalidate` clears them, e.g. after changing
+# someone's signoffs; logging out clears the user's own entry.
+WA_REPORTING_ACCESS_TTL = int(os.environ.get("WA_REPORTING_ACCESS_TTL", 900))  # seconds
+SIGNOFFS_FIELD = "NL Signoffs and Categories"
+REPORTING_SIGNOFF = "[NL] reporting"
+_access_store = None
+_access_store_lock = threading.Lock()
+
+
+def _get_access_store():
+    global _access_store
+    if _access_store is None:
+        _access_store = localstore.connect("auth.sqlite3")
+        _access_store.execute(
+            "CREATE TABLE IF NOT EXISTS report_access (contact_id INTEGER PRIMARY KEY, "
+            "allowed INTEGER, checked_at REAL)"
+        )
+    return _access_store
+
+
+def get_contact_id():
+    """Return the logged in user's contact id, asking the API once per session."""
+    if 'contact_id' not in session:
+        # Use the user token to get the current user's info
+        oauth_user = OAuth2Session(token=session['user_token'])
+        response = ratelimit.send(lambda: oauth_user.get(url = f"{WA_API_PREFIX}/contacts/me"))
+        if response.status_code != 200:
+            raise Exception(f"Error getting user info, response code was {response.status_code}.")
+        logger.debug("Response from Wild Apricot:\n %s", metrics.lazy_json(response.json()))
+        session['contact_id'] = response.json().get('Id')
+    return session['contact_id']
+
 
 def check_report_access():
-    # Use the user token to get the current user's info
-    oauth_user = OAuth2Session(token=session['user_token'])    
-    response = oauth_user.get(url = f"{WA_API_PREFIX}/contacts/me")
-
-    if response.status_code == 200:
-        logger.debug(f"Response from Wild Apricot:\n {json.dumps(response.json(), indent=4)}")
-
-        # we got it, now use the contact id to get the contact's fields        
-        contact_id = response.json().get('Id')
-        oauth_app = get_oauth_session()
-        
-        logger.debug(f"About to call the API for user's signoffs with contact id {contact_id}...")
-        response = oauth_app.get(url = f"{WA_API_PREFIX}/contacts/{contact_id}",
-                                 params = {("&async", "false"), ("&includeFieldValues", "true")})
-        
-        if response.status_code == 200:
-            logger.debug(f"Response from Wild Apricot:\n {json.dumps(response.json(), indent=4)}")
-            '''
-            see https://app.swaggerhub.com/apis-docs/WildApricot/wild-apricot_api_for_non_administrative_access/7.15.0#/Contacts/get_accounts__accountId__contacts_me
-            need signoff "[NL] reporting" from field name "NL Signoffs and Categories" 
-            see https://github.com/nova-labs/watto/blob/main/app/models/field.rb and
-            https://github.com/nova-labs/watto/blob/main/app/models/user.rb
-            based on what I see in the portal, if a signoff with the right name exists, the user has it.
-            '''
-            # Extract the FieldValues list
-            field_values = response.json().get('FieldValues', [])
-
-            # Find the NL Signoffs and Categories field
-            signoffs_field = next((field for field in field_values if field['FieldName'] == 'NL Signoffs and Categories'), None)
-            # If the field was found and it has a non-empty value, check if [NL] reporting is present
-            if signoffs_field and signoffs_field['Value']:
-                labels = [item['Label'] for item in signoffs_field['Value']]
-                if '[NL] reporting' in labels:
-                    return True
-                else:
-                    return False
-            else:
-                logger.warning("NL Signoffs and Categories field is not present or has an empty value")
-                return False
+    """Return whether the logged in user has the reporting signoff, cached per contact."""
+    contact_id = get_contact_id()
+    with _access_store_lock:
+        row = _get_access_store().execute(
+            "SELECT allowed FROM report_access WHERE contact_id = ? AND checked_at > ?",
+            (contact_id, time.time() - WA_REPORTING_ACCESS_TTL),
+        ).fetchone()
+    if row is not None:
+        logger.debug(f"Report access for contact {contact_id} found in cache.")
+        return bool(row[0])
+
+    allowed = _fetch_report_access(contact_id)
+    with _access_store_lock:
+        _get_access_store().execute("INSERT OR REPLACE INTO report_access VALUES (?, ?, ?)",
+                                    (contact_id, int(allowed), time.time()))
+    return allowed
+
 
+def invalidate_report_access(contact_id=None):
+    """Forget cached access decisions, for one contact or for everyone."""
+    with _access_store_lock:
+        if contact_id is None:
+            _get_access_store().execute("DELETE FROM report_access")
         else:
+            _get_access_store().execute("DELETE FROM report_access WHERE contact_id = ?", (contact_id,))
+
+
+def _fetch_report_access(contact_id):
+    """Look up the contact's signoffs, fetching only the signoff field."""
+    oauth_app = get_oauth_session()
+    logger.debug(f"About to call the API for user's signoffs with contact id {contact_id}...")
+    response = ratelimit.send(lambda: oauth_app.get(url = f"{WA_API_PREFIX}/contacts",
+                              params = [("$async", "false"), ("$filter", f"Id eq {contact_id}"),
+                                        ("$select", f"'{SIGNOFFS_FIELD}'")]))
+    if response.status_code != 200:
+        raise Exception(f"Error getting user signoffs, response code was {response.status_code}.")
+    logger.debug("Response from Wild Apricot:\n %s", metrics.lazy_json(response.json()))
+    contacts = response.json().get('Contacts') or []
+    field_values = contacts[0].get('FieldValues', []) if contacts else []
+
+    if not any(field['FieldName'] == SIGNOFFS_FIELD for field in field_values):
+        # Not what we expected from the narrowed query; fall back to the full record
+        logger.warning(f"Signoff field missing from the narrowed contact query, fetching contact {contact_id}.")
+        response = ratelimit.send(lambda: oauth_app.get(url = f"{WA_API_PREFIX}/contacts/{contact_id}",
+                                  params = [("$async", "false"), ("includeFieldValues", "true")]))
+        if response.status_code != 200:
             raise Exception(f"Error getting user signoffs, response code was {response.status_code}.")
-    else:        
-        raise Exception(f"Error getting user info, response code was {response.status_code}.")
-    return False
\ No newline at end of file
+        field_values = response.json().get('FieldValues', [])
+
+    '''
+    see https://app.swaggerhub.com/apis-docs/WildApricot/wild-apricot_api_for_non_administrative_access/7.15.0#/Contacts/get_accounts__accountId__contacts_me
+    need signoff "[NL] reporting" from field name "NL Signoffs and Categories" 
+    see https://github.com/nova-labs/watto/blob/main/app/models/field.rb and
+    https://github.com/nova-labs/watto/blob/main/app/models/user.rb
+    based on what I see in the portal, if a signoff with the right name exists, the user has it.
+    '''
+    # Find the NL Signoffs and Categories field
+    signoffs_field = next((field for field in field_values if field['FieldName'] == SIGNOFFS_FIELD), None)
+    # If the field was found and it has a non-empty value, check if [NL] reporting is present
+    if signoffs_field and signoffs_field['Value']:
+        labels = [item['Label'] for item in signoffs_field['Value']]
+        return REPORTING_SIGNOFF in labels
+    logger.warning("NL Signoffs and Categories field is not present or has an empty value")
+    return False
+
+
+@click.command("access-invalidate")
+@click.argument("contact_id", type=int, required=False)
+def invalidate_access_command(contact_id):
+    """Forget cached report access decisions (for CONTACT_ID, or everyone)."""
+    invalidate_report_access(contact_id)
@@ -0,0 +1,271 @@
+"""A local stand-in for the Wild Apricot API, for benchmarks and offline runs.
+
+Serves synthetic Contacts, Events and EventRegistrations with the same
+paging ($top/$skip/$count), $select and response shapes wadata relies on,
+plus the client-credentials token endpoint. Latency and 429 responses can be
+injected, and requests are counted per category (GET /_mock/requests,
+reset with POST /_mock/reset).
+
+Run it on its own to point a development server at it:
+
+    python -m benchmarks.mockwa --scale 10000 --port 8901
+
+then set WA_API_PREFIX=http://127.0.0.1:8901/v2.2/Accounts/1 and
+WA_API_TOKEN_URL=http://127.0.0.1:8901/auth/token.
+"""
+import re
+import time
+import random
+import argparse
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from flask import Flask, request, jsonify
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+ACCOUNT_ID = 1
+YOUTH_ROBOTICS_LEVEL_ID = 1214629
+MEMBERSHIP_LEVELS = [1200001, 1200002, 1200003, YOUTH_ROBOTICS_LEVEL_ID]
+STATUSES = ['Active'] * 8 + ['PendingRenewal', 'Lapsed']
+# $select names the API uses for fields whose record key differs
+SELECT_NAMES = {'e-Mail': 'Email'}
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+
+
+def make_dataset(contacts=1000, seed=1):
+    """Build a deterministic synthetic account with `contacts` contacts and a tenth as many events."""
+    rng = random.Random(seed)
+    now = datetime.now(timezone(timedelta(hours=-5))).replace(minute=0, second=0, microsecond=0)
+
+    contact_records = []
+    for i in range(1, contacts + 1):
+        contact_records.append({
+            'Id': i,
+            'FirstName': f"First{i}",
+            'LastName': f"Last{i}",
+            'DisplayName': f"Last{i}, First{i}",
+            'Email': f"member{i}@example.org",
+            'MembershipEnabled': rng.random() < 0.9,
+            'MembershipLevel': {'Id': rng.choice(MEMBERSHIP_LEVELS)},
+            'Status': rng.choice(STATUSES),
+        })
+
+    event_records = []
+    for i in range(1, max(contacts // 10, 1) + 1):
+        start = now - timedelta(days=rng.uniform(-60, 400))
+        kind = rng.choice(['_S', '_P', '_S', 'Open House', 'Meeting'])
+        name = f"Class{kind} {i}" if kind.startswith('_') else f"{kind} {i}"
+        if rng.random() < 0.05:
+            name += " CANCELLED"
+        event_records.append({
+            'Id': 100000 + i,
+            'Name': name,
+            'StartDate': start.strftime(DATE_FORMAT),
+            'EndDate': (start + timedelta(hours=3)).strftime(DATE_FORMAT),
+            'ConfirmedRegistrationsCount': rng.randint(0, 12),
+            'RegistrationsLimit': 12,
+            'Tags': ['ms'] if rng.random() < 0.1 else [],
+        })
+
+    return {'seed': seed, 'now': now, 'Contacts': contact_records, 'Events': event_records}
+
+
+def registrations_for(dataset, event_id):
+    """Registrations for an event, generated on demand (deterministic per event)."""
+    rng = random.Random(dataset['seed'] * 1000003 + event_id)
+    registrations = []
+    for n in range(rng.randint(3, 12)):
+        contact = rng.choice(dataset['Contacts'])
+        instructor = n == 0
+        registrations.append({
+            'Id': event_id * 100 + n,
+            'Event': {'Id': event_id},
+            'Contact': {'Id': contact['Id']},
+            'DisplayName': contact['DisplayName'],
+            'RegistrationType': {'Name': 'Instructor' if instructor else 'Attendee'},
+            'IsCheckedIn': rng.random() < (0.8 if instructor else 0.5),
+        })
+    return registrations
+
+
+def _filter_contacts(contacts, filter_string):
+    if 'IsMember eq true' in filter_string:
+        contacts = [c for c in contacts if c['MembershipEnabled']]
+    excluded = re.search(r"MembershipLevelId ne (\d+)", filter_string)
+    if excluded:
+        contacts = [c for c in contacts if c['MembershipLevel']['Id'] != int(excluded.group(1))]
+    statuses = re.findall(r"'Status' eq '(\w+)'", filter_string)
+    if statuses:
+        contacts = [c for c in contacts if c['Status'] in statuses]
+    return contacts
+
+
+def _filter_events(events, filter_string, now):
+    for operator, value in re.findall(r"StartDate (gt|ge) (\d{4}-\d{2}-\d{2})", filter_string):
+        if operator == 'gt':
+            events = [e for e in events if e['StartDate'][:10] > value]
+        else:
+            events = [e for e in events if e['StartDate'][:10] >= value]
+    upcoming = re.search(r"IsUpcoming eq (true|false)", filter_string)
+    if upcoming:
+        wanted = upcoming.group(1) == 'true'
+        events = [e for e in events if (datetime.strptime(e['StartDate'], DATE_FORMAT) > now) == wanted]
+    names = re.findall(r"substringof\('Name', '([^']+)'\)", filter_string)
+    if names:
+        events = [e for e in events if any(name in e['Name'] for name in names)]
+    tags = re.search(r"Tags in \[(\w+)\]", filter_string)
+    if tags:
+        events = [e for e in events if tags.group(1) in e['Tags']]
+    return events
+
+
+def _select(records, select_string):
+    if not select_string:
+        return records
+    keep = {SELECT_NAMES.get(name, name) for name in re.findall(r"'([^']+)'", select_string)} | {'Id'}
+    return [{key: value for key, value in record.items() if key in keep} for record in records]
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class MockWildApricot:
+    """A mock Wild Apricot API server running in a background thread.
+
+    latency: seconds added to every API response.
+    throttle_every: answer every Nth API request with a 429 (0 = never).
+    retry_after: the Retry-After value sent with injected 429s, in seconds.
+    """
+
+    def __init__(self, dataset, latency=0.0, throttle_every=0, retry_after=0.1, port=0):
+        self.dataset = dataset
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.requests = Counter()
+        self._lock = threading.Lock()
+        self._api_calls = 0
+        self._filter_cache = {}
+        self._server = make_server("127.0.0.1", port, self._make_app(), threaded=True,
+                                   request_handler=_QuietRequestHandler)
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    @property
+    def api_prefix(self):
+        return f"{self.url}/v2.2/Accounts/{ACCOUNT_ID}"
+
+    @property
+    def token_url(self):
+        return f"{self.url}/auth/token"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._thread.join()
+
+    def reset_counts(self):
+        with self._lock:
+            self.requests.clear()
+
+    def _count(self, name):
+        with self._lock:
+            self.requests[name] += 1
+            if name in ('throttled', 'token'):
+                return 0
+            self._api_calls += 1
+            return self._api_calls
+
+    def _filtered(self, category, filter_string):
+        # Paging asks for the same filter over and over; filter once so the
+        # mock's own cost doesn't swamp what is being measured
+        key = (category, filter_string)
+        with self._lock:
+            records = self._filter_cache.get(key)
+        if records is None:
+            if category == 'Contacts':
+                records = _filter_contacts(self.dataset['Contacts'], filter_string)
+            else:
+                records = _filter_events(self.dataset['Events'], filter_string, self.dataset['now'])
+            with self._lock:
+                self._filter_cache[key] = records
+        return records
+
+    def _make_app(self):
+        app = Flask(__name__)
+
+        @app.post("/auth/token")
+        def token():
+            self._count('token')
+            return jsonify(access_token=f"mock-{time.time()}", token_type="Bearer", expires_in=1800)
+
+        # Request counters, for benchmarks running the server in another process
+        @app.get("/_mock/requests")
+        def request_counts():
+            with self._lock:
+                return jsonify(self.requests)
+
+        @app.post("/_mock/reset")
+        def reset():
+            self.reset_counts()
+            return jsonify(ok=True)
+
+        @app.get(f"/v2.2/Accounts/{ACCOUNT_ID}/<category>")
+        def collection(category):
+            call = self._count(category)
+            if self.latency:
+                time.sleep(self.latency)
+            if self.throttle_every and call % self.throttle_every == 0:
+                self._count('throttled')
+                return jsonify(message="Too many requests"), 429, {'Retry-After': str(self.retry_after)}
+
+            filter_string = request.args.get('$filter', '')
+            if category == 'EventRegistrations':
+                event_id = request.args.get('eventId', type=int)
+                return jsonify(_select(registrations_for(self.dataset, event_id), request.args.get('$select')))
+            if category not in ('Contacts', 'Events'):
+                return jsonify(message=f"Unknown category {category}"), 404
+            records = self._filtered(category, filter_string)
+
+            if request.args.get('$count') == 'true':
+                return jsonify(Count=len(records))
+            skip = request.args.get('$skip', 0, type=int)
+            top = request.args.get('$top', type=int)
+            page = records[skip:skip + top] if top is not None else records[skip:]
+            return jsonify({category: _select(page, request.args.get('$select'))})
+
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a mock Wild Apricot API server.")
+    parser.add_argument("--scale", type=int, default=1000, help="number of contacts (events are a tenth of this)")
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every API response")
+    parser.add_argument("--throttle-every", type=int, default=0, help="answer every Nth API request with a 429")
+    args = parser.parse_args()
+
+    server = MockWildApricot(make_dataset(args.scale), latency=args.latency, throttle_every=args.throttle_every,
+                             port=args.port).start()
+    print(f"Mock Wild Apricot API with {args.scale} contacts")
+    print(f"WA_API_PREFIX={server.api_prefix}")
+    print(f"WA_API_TOKEN_URL={server.token_url}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
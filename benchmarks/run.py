@@ -0,0 +1,216 @@
+"""Benchmark the reports against the mock Wild Apricot server.
+
+For each scale and report this records wall time, the number of API requests
+(by category, and how many were throttled) and peak Python memory, e.g.
+
+    python -m benchmarks.run --scale 1k,10k --latency 0.02 --output results.json
+
+Compare against an earlier run to catch regressions; the exit status is 1 if
+any report got slower than the tolerance allows or makes more API requests:
+
+    python -m benchmarks.run --scale 1k,10k --latency 0.02 --baseline results.json
+
+Everything runs offline. The mock server runs in its own process, so memory
+and CPU figures are the application's alone. Credentials are dummies, the
+rate limiter state and other local stores go to a temporary directory, and
+the mirror, response cache and checkin verdict index are off unless set in
+the environment.
+"""
+import io
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from datetime import datetime, timedelta
+
+import requests
+
+from benchmarks import mockwa
+
+SCALES = {'1k': 1000, '10k': 10000, '100k': 100000}
+REPORTS = ['missing_instructor_checkins', 'slack_orphans', 'makerschool_registrations', 'all_dashboards']
+
+
+class MockServerProcess:
+    """benchmarks.mockwa running in a child process."""
+
+    def __init__(self, scale, latency, throttle_every):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        self.api_prefix = f"{self.url}/v2.2/Accounts/{mockwa.ACCOUNT_ID}"
+        self.token_url = f"{self.url}/auth/token"
+        self._process = subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.mockwa", "--scale", str(scale), "--port", str(port),
+             "--latency", str(latency), "--throttle-every", str(throttle_every)],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), stdout=subprocess.DEVNULL)
+        deadline = time.monotonic() + 120
+        while True:
+            try:
+                self.request_counts()
+                return
+            except requests.ConnectionError:
+                if self._process.poll() is not None or time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError("The mock Wild Apricot server did not start")
+                time.sleep(0.2)
+
+    def request_counts(self):
+        return requests.get(f"{self.url}/_mock/requests").json()
+
+    def reset_counts(self):
+        requests.post(f"{self.url}/_mock/reset")
+
+    def stop(self):
+        self._process.terminate()
+        self._process.wait()
+
+
+def configure_environment(server, data_dir):
+    """Point the application modules at the mock server. Must run before they are imported."""
+    os.environ["WA_API_PREFIX"] = server.api_prefix
+    os.environ["WA_API_TOKEN_URL"] = server.token_url
+    os.environ["WA_REPORTING_DATA_DIR"] = data_dir
+    # the mock server speaks plain HTTP
+    os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
+    for name, value in [("WA_REPORTING_API_KEY", "benchmark"), ("WA_REPORTING_CLIENT_SECRET", "benchmark"),
+                        ("WA_REPORTING_FLASK_SECRET_KEY", "benchmark"), ("WA_REPORTING_DOMAIN", "localhost"),
+                        # measure the client, not the production rate limit
+                        ("WA_API_RATE", "1000"), ("WA_API_BURST", "100"), ("WA_API_BACKOFF_BASE", "0.05"),
+                        ("WA_API_CACHE", "off"), ("WA_MIRROR", "false"), ("WA_CHECKIN_INDEX", "false")]:
+        os.environ.setdefault(name, value)
+
+
+def slack_export(dataset, orphans=0.1):
+    """A Slack member export with every fifth contact plus some users who are not contacts."""
+    lines = ["username,email,fullname,status"]
+    for contact in dataset['Contacts'][::5]:
+        lines.append(f"{contact['FirstName'].lower()},{contact['Email']},{contact['DisplayName'].replace(',', '')},active")
+    for i in range(int(len(dataset['Contacts']) / 5 * orphans)):
+        lines.append(f"stranger{i},stranger{i}@example.com,Stranger {i},active")
+    return "\n".join(lines) + "\n"
+
+
+def run_report(name, dataset):
+    # Imported here, after configure_environment
+    import reports
+
+    if name == 'missing_instructor_checkins':
+        start_date = (datetime.today() - timedelta(days=365)).strftime('%Y-%m-%d')
+        return reports.get_missing_instructor_checkins(start_date)
+    if name == 'slack_orphans':
+        df = reports.read_slack_export(io.StringIO(slack_export(dataset)))
+        return reports.get_slack_orphans(df)
+    if name == 'makerschool_registrations':
+        return reports.get_makerschool_registrations()
+    if name == 'all_dashboards':
+        start_date = (datetime.today() - timedelta(days=365)).strftime('%Y-%m-%d')
+        return reports.get_all_dashboards(start_date)
+    raise ValueError(f"Unknown report {name}")
+
+
+def measure(name, dataset, server):
+    from flask import Flask
+
+    server.reset_counts()
+    # Report tasks run with a copy of the request context, and big Slack
+    # exports go to the "cpu" process pool as configured in wareporting.py
+    app = Flask(__name__)
+    app.config['CPU_EXECUTOR_TYPE'] = 'process'
+    with app.test_request_context():
+        tracemalloc.start()
+        start = time.perf_counter()
+        run_report(name, dataset)
+        wall = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    counts = server.request_counts()
+    return {
+        'wall_seconds': round(wall, 3),
+        'requests': sum(count for category, count in counts.items() if category not in ('token', 'throttled')),
+        'throttled': counts.get('throttled', 0),
+        'requests_by_category': {category: count for category, count in counts.items()
+                                 if category not in ('token', 'throttled')},
+        'peak_memory_bytes': peak,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return a description of each result that regressed against the baseline."""
+    regressions = []
+    for key, result in results.items():
+        before = baseline.get(key)
+        if before is None:
+            continue
+        if result['wall_seconds'] > before['wall_seconds'] * (1 + tolerance):
+            regressions.append(f"{key}: wall time {before['wall_seconds']}s -> {result['wall_seconds']}s")
+        if result['requests'] > before['requests']:
+            regressions.append(f"{key}: API requests {before['requests']} -> {result['requests']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the reports against a mock Wild Apricot API.")
+    parser.add_argument("--scale", default="1k,10k", help=f"comma separated, from {', '.join(SCALES)}")
+    parser.add_argument("--reports", default=",".join(REPORTS), help="comma separated report names")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every API response")
+    parser.add_argument("--throttle-every", type=int, default=0, help="answer every Nth API request with a 429")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results from an earlier --output")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed wall time increase (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    scales = [scale.strip() for scale in args.scale.split(",")]
+    report_names = [name.strip() for name in args.reports.split(",")]
+    for scale in scales:
+        if scale not in SCALES:
+            parser.error(f"Unknown scale {scale}")
+    for name in report_names:
+        if name not in REPORTS:
+            parser.error(f"Unknown report {name}")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        for scale in scales:
+            # the same data the server generates, for building the Slack export
+            dataset = mockwa.make_dataset(SCALES[scale])
+            server = MockServerProcess(SCALES[scale], args.latency, args.throttle_every)
+            try:
+                configure_environment(server, data_dir)
+                # Import the app before timing anything, including pandas, which
+                # reports only imports when a Slack report first needs it
+                import reports  # noqa: F401
+                import pandas  # noqa: F401
+                # The app reads the API prefix at import; follow the server when it moves
+                if "auth" in sys.modules:
+                    sys.modules["auth"].WA_API_PREFIX = server.api_prefix
+                    sys.modules["auth"].WA_API_TOKEN_URL = server.token_url
+                for name in report_names:
+                    result = measure(name, dataset, server)
+                    results[f"{scale}/{name}"] = result
+                    print(f"{scale:>5} {name:<30} {result['wall_seconds']:>8.3f}s {result['requests']:>7} requests "
+                          f"{result['throttled']:>5} throttled {result['peak_memory_bytes'] / 1e6:>8.1f} MB peak")
+            finally:
+                server.stop()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
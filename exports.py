@@ -0,0 +1,166 @@
+import io
+import csv
+import importlib.util
+
+# pyarrow is optional; without it only CSV downloads are offered. It is only
+# imported when a Parquet or Arrow download is made, not at startup.
+HAVE_PYARROW = importlib.util.find_spec("pyarrow") is not None
+
+
+def _pyarrow():
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+    return pyarrow
+
+# Report results (as stored in the job store) flattened into rows for download.
+# Downloads are generated while they are sent: CSV goes out in small chunks,
+# Parquet and Arrow one batch of BATCH_ROWS rows at a time, so a large export
+# starts downloading at once and is never held in memory as a whole file.
+CSV_CHUNK_BYTES = 16 * 1024
+BATCH_ROWS = 10000
+
+
+def _missing_instructor_checkins_rows(result):
+    flawed_events, start_date = result
+    for event in flawed_events:
+        yield [event[0], event[1], event[2], "; ".join(event[3:])]
+
+
+def _slack_orphans_rows(result):
+    orphans, num_membership_emails = result
+    for orphan in orphans:
+        yield [orphan['username'], orphan['fullname'], orphan['email']]
+
+
+def _makerschool_registrations_rows(result):
+    events, total_registrations, total_registration_limit = result
+    for event_id, event in events.items():
+        yield [int(event_id), event['Name'], event['ConfirmedRegistrationsCount'], event['RegistrationsLimit'],
+               event['StartDate'], event['EndDate']]
+
+
+# Report name -> (report function name, [(column, type)], rows function)
+REPORTS = {
+    'missing_instructor_checkins': (
+        'get_missing_instructor_checkins',
+        [('event_id', 'int'), ('event_name', 'string'), ('start', 'string'), ('missing_instructors', 'string')],
+        _missing_instructor_checkins_rows,
+    ),
+    'slack_orphans': (
+        'get_slack_orphans',
+        [('username', 'string'), ('fullname', 'string'), ('email', 'string')],
+        _slack_orphans_rows,
+    ),
+    'makerschool_registrations': (
+        'get_makerschool_registrations',
+        [('event_id', 'int'), ('name', 'string'), ('registered', 'int'), ('limit', 'int'),
+         ('start_date', 'string'), ('end_date', 'string')],
+        _makerschool_registrations_rows,
+    ),
+}
+
+
+def stream_csv(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, _ in columns])
+    # send the header right away so the download starts
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= CSV_CHUNK_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+class _StreamSink(io.RawIOBase):
+    """A write-only file that hands back what was written since the last drain()."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _arrow_schema(columns):
+    pyarrow = _pyarrow()
+    types = {'int': pyarrow.int64(), 'string': pyarrow.string()}
+    return pyarrow.schema([(name, types[kind]) for name, kind in columns])
+
+
+def _record_batch(schema, rows):
+    pyarrow = _pyarrow()
+    columns = zip(*rows)
+    return pyarrow.RecordBatch.from_arrays(
+        [pyarrow.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema)
+
+
+def _batches(schema, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_ROWS:
+            yield _record_batch(schema, batch)
+            batch = []
+    if batch:
+        yield _record_batch(schema, batch)
+
+
+def stream_parquet(columns, rows):
+    pyarrow = _pyarrow()
+    schema = _arrow_schema(columns)
+    sink = _StreamSink()
+    # each batch becomes a row group, sent as soon as it is written
+    with pyarrow.parquet.ParquetWriter(sink, schema) as writer:
+        for batch in _batches(schema, rows):
+            writer.write_batch(batch)
+            yield sink.drain()
+    yield sink.drain()
+
+
+def stream_arrow(columns, rows):
+    pyarrow = _pyarrow()
+    schema = _arrow_schema(columns)
+    sink = _StreamSink()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        yield sink.drain()
+        for batch in _batches(schema, rows):
+            writer.write_batch(batch)
+            yield sink.drain()
+    yield sink.drain()
+
+
+# Format -> (MIME type, generator)
+FORMATS = {
+    'csv': ('text/csv', stream_csv),
+    'parquet': ('application/vnd.apache.parquet', stream_parquet),
+    'arrow': ('application/vnd.apache.arrow.stream', stream_arrow),
+}
+
+
+def available_formats():
+    if not HAVE_PYARROW:
+        return ['csv']
+    return list(FORMATS)
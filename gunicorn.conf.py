@@ -0,0 +1,18 @@
+# gunicorn reads this file when started from this directory (see README.md).
+# Command line options override these settings.
+
+# The processing page long-polls /reports/task_status, holding a request open
+# for up to reports.TASK_STATUS_MAX_WAIT seconds, so each worker serves
+# requests from a pool of threads; with the default single-threaded sync
+# worker a few people waiting on reports would block logins and /metrics.
+worker_class = "gthread"
+threads = 16
+
+
+def post_worker_init(worker):
+    # Start each worker's pre-warm scheduler as soon as the worker has loaded
+    # the app, rather than with its first request, so an early scheduled run
+    # is not missed after a deploy or a worker restart
+    import scheduler
+
+    scheduler.start(worker.wsgi)
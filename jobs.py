@@ -0,0 +1,255 @@
+import json
+import time
+import uuid
+import zlib
+import logging
+import threading
+
+import localstore
+
+logger = logging.getLogger(__name__)
+
+# Report jobs and their results, kept in SQLite so that any gunicorn worker
+# can answer a status poll or serve a result, whichever worker ran the job.
+# Results are stored as compressed JSON, so tuples come back as lists and
+# dict keys as strings. Finished jobs expire after a TTL, oversized results
+# are refused, and the oldest results are evicted to keep the store bounded.
+#
+# Results pre-warmed by the scheduler (see scheduler.py) are "warm": the
+# warm table points each pre-warmed report at its latest result, one key per
+# report, which is exempt from eviction until it is older than the pre-warm
+# max age and does not count towards the store's size limit. Any later
+# successful run of the same key, such as a user's "recompute", becomes the
+# new warm result.
+RUNNING = "running"
+DONE = "done"
+ERROR = "error"
+
+# A running job's worker touches it every HEARTBEAT_SECONDS (see Heartbeat);
+# one that has not been touched for STALE_SECONDS is assumed to have died
+# with its worker, so the next request for the same report starts it again.
+HEARTBEAT_SECONDS = 5
+STALE_SECONDS = 60
+# Write progress to the store at most this often per job
+PROGRESS_INTERVAL = 0.5
+
+_conn = None
+_conn_lock = threading.RLock()
+
+
+def _connect():
+    global _conn
+    with _conn_lock:
+        if _conn is None:
+            _conn = localstore.connect("jobs.sqlite3")
+            _conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    task_id TEXT PRIMARY KEY, key TEXT, report TEXT, status TEXT,
+                    created REAL, updated REAL, finished REAL,
+                    progress TEXT, result BLOB, result_size INTEGER, error TEXT);
+                CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key);
+                CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished);
+                CREATE TABLE IF NOT EXISTS warm (key TEXT PRIMARY KEY, task_id TEXT, report TEXT);
+                CREATE TABLE IF NOT EXISTS schedule (name TEXT PRIMARY KEY, last_slot REAL);
+            """)
+        return _conn
+
+
+def claim(key, report, reuse_seconds):
+    """Find a job to reuse for this key, or register a new one.
+
+    Returns (task_id, created). A job is reused while it is running, or for
+    reuse_seconds after it succeeds. The lookup and insert are one
+    transaction, so two workers can't both start the same report.
+    """
+    now = time.time()
+    with _conn_lock:
+        conn = _connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT task_id FROM jobs WHERE key = ? AND ((status = ? AND updated >= ?) "
+                "OR (status = ? AND finished >= ?)) ORDER BY created DESC LIMIT 1",
+                (key, RUNNING, now - STALE_SECONDS, DONE, now - reuse_seconds),
+            ).fetchone()
+            if row is not None:
+                conn.execute("COMMIT")
+                return row[0], False
+            task_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (task_id, key, report, status, created, updated, result_size) "
+                "VALUES (?, ?, ?, ?, ?, ?, 0)",
+                (task_id, key, report, RUNNING, now, now),
+            )
+            conn.execute("COMMIT")
+            return task_id, True
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def progress_writer(task_id):
+    """Return a listener for progress.Progress that saves snapshots, throttled to PROGRESS_INTERVAL."""
+    last_write = [0.0]
+
+    def write(snapshot, force=False):
+        now = time.time()
+        if not force and now - last_write[0] < PROGRESS_INTERVAL:
+            return
+        last_write[0] = now
+        with _conn_lock:
+            _connect().execute("UPDATE jobs SET progress = ?, updated = ? WHERE task_id = ?",
+                               (json.dumps(snapshot), now, task_id))
+
+    return write
+
+
+class Heartbeat:
+    """Marks a running job alive in the background until the block exits."""
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"job-heartbeat-{task_id}", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(HEARTBEAT_SECONDS):
+            try:
+                with _conn_lock:
+                    _connect().execute("UPDATE jobs SET updated = ? WHERE task_id = ? AND status = ?",
+                                       (time.time(), self.task_id, RUNNING))
+            except Exception:
+                logger.exception(f"Could not record a heartbeat for job {self.task_id}.")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def finish(task_id, result=None, error=None, max_result_bytes=None):
+    """Record a job's result, or its error message."""
+    now = time.time()
+    blob = None
+    if error is None:
+        try:
+            blob = zlib.compress(json.dumps(result).encode("utf-8"))
+        except (TypeError, ValueError) as e:
+            error = f"Report result could not be stored: {e}"
+        else:
+            if max_result_bytes is not None and len(blob) > max_result_bytes:
+                error = (f"Report result is too large to store ({len(blob)} bytes compressed). "
+                         f"Please narrow your search.")
+                blob = None
+    with _conn_lock:
+        conn = _connect()
+        conn.execute(
+            "UPDATE jobs SET status = ?, updated = ?, finished = ?, result = ?, result_size = ?, error = ? "
+            "WHERE task_id = ?",
+            (DONE if error is None else ERROR, now, now, blob, len(blob) if blob else 0, error, task_id),
+        )
+        if error is None:
+            conn.execute("UPDATE warm SET task_id = ? WHERE key = (SELECT key FROM jobs WHERE task_id = ?)",
+                         (task_id, task_id))
+
+
+def set_warm(key, task_id, report):
+    """Keep task_id's result as the warm result for key, replacing report's earlier warm keys.
+
+    A report's arguments can change between pre-warms (a date range ending
+    today, say), so only its latest key stays warm.
+    """
+    with _conn_lock:
+        conn = _connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM warm WHERE report = ? AND key != ?", (report, key))
+            conn.execute("INSERT OR REPLACE INTO warm (key, task_id, report) VALUES (?, ?, ?)",
+                         (key, task_id, report))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def find_warm(key, max_age_seconds):
+    """Return the task id of key's warm result if it finished within max_age_seconds, else None."""
+    with _conn_lock:
+        row = _connect().execute(
+            "SELECT jobs.task_id FROM warm JOIN jobs ON jobs.task_id = warm.task_id "
+            "WHERE warm.key = ? AND jobs.status = ? AND jobs.finished >= ?",
+            (key, DONE, time.time() - max_age_seconds),
+        ).fetchone()
+    return row[0] if row else None
+
+
+def claim_slot(name, slot):
+    """Claim a scheduled run (name at timestamp slot) for this worker; False if another already has."""
+    with _conn_lock:
+        conn = _connect()
+        conn.execute(
+            "INSERT INTO schedule (name, last_slot) VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET last_slot = excluded.last_slot WHERE last_slot < excluded.last_slot",
+            (name, slot),
+        )
+        return conn.execute("SELECT changes()").fetchone()[0] == 1
+
+
+def get(task_id):
+    """Return a job's report, status, progress, error and finish time (not its result), or None if unknown."""
+    with _conn_lock:
+        row = _connect().execute(
+            "SELECT report, status, updated, finished, progress, error FROM jobs WHERE task_id = ?", (task_id,)
+        ).fetchone()
+    if row is None:
+        return None
+    report, status, updated, finished, job_progress, error = row
+    if status == RUNNING and updated < time.time() - STALE_SECONDS:
+        status, error = ERROR, "The report stopped responding. Please run it again."
+    return {"report": report, "status": status, "progress": json.loads(job_progress) if job_progress else None,
+            "error": error, "finished": finished}
+
+
+def load_result(task_id):
+    with _conn_lock:
+        row = _connect().execute("SELECT result FROM jobs WHERE task_id = ?", (task_id,)).fetchone()
+    if row is None or row[0] is None:
+        return None
+    return json.loads(zlib.decompress(row[0]))
+
+
+def evict(ttl_seconds, max_total_bytes, warm_max_age_seconds=0):
+    """Drop expired and stale jobs, then the oldest results until the store is under max_total_bytes.
+
+    max_total_bytes=None means no size limit. Warm results are kept, and left
+    out of the size total, until they are older than warm_max_age_seconds.
+    """
+    now = time.time()
+    with _conn_lock:
+        conn = _connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Warm results too old to be served are ordinary results again
+            conn.execute("DELETE FROM warm WHERE task_id NOT IN "
+                         "(SELECT task_id FROM jobs WHERE finished IS NULL OR finished >= ?)",
+                         (now - warm_max_age_seconds,))
+            conn.execute("DELETE FROM jobs WHERE finished < ? AND task_id NOT IN (SELECT task_id FROM warm)",
+                         (now - ttl_seconds,))
+            conn.execute("DELETE FROM jobs WHERE status = ? AND updated < ?", (RUNNING, now - 2 * STALE_SECONDS))
+            total = conn.execute("SELECT COALESCE(SUM(result_size), 0) FROM jobs "
+                                 "WHERE task_id NOT IN (SELECT task_id FROM warm)").fetchone()[0]
+            if max_total_bytes is not None and total > max_total_bytes:
+                for task_id, size in conn.execute(
+                        "SELECT task_id, result_size FROM jobs WHERE finished IS NOT NULL "
+                        "AND task_id NOT IN (SELECT task_id FROM warm) ORDER BY finished").fetchall():
+                    if total <= max_total_bytes:
+                        break
+                    conn.execute("DELETE FROM jobs WHERE task_id = ?", (task_id,))
+                    total -= size
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
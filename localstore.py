@@ -0,0 +1,28 @@
+import os
+import sqlite3
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Small on-disk stores (rate limiter state, caches, job records) live here.
+# Every gunicorn worker on the host opens the same files, which is how state
+# is shared between processes. Keep this directory out of git.
+DATA_DIR = os.environ.get(
+    "WA_REPORTING_DATA_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "var"),
+)
+
+
+def connect(filename):
+    """Open a SQLite database in DATA_DIR that is safe to share between processes.
+
+    Connections are in autocommit mode; callers that need atomic
+    read-modify-write should issue BEGIN IMMEDIATE themselves.
+    """
+    os.makedirs(DATA_DIR, exist_ok=True)
+    path = os.path.join(DATA_DIR, filename)
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    logger.debug(f"Opened local store {path}")
+    return conn
@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import logging
+import threading
+import contextvars
+
+from flask import Blueprint, Response, request
+
+import ratelimit
+
+logger = logging.getLogger(__name__)
+
+metrics_blueprint = Blueprint('metrics', __name__)
+
+# Process-local instrumentation for Wild Apricot API calls and report runs,
+# exposed in Prometheus text format at /metrics. Each gunicorn worker reports
+# its own numbers; scrape them all, or sum them, for the whole picture.
+# Set WA_REPORTING_METRICS_TOKEN to require "Authorization: Bearer <token>".
+METRICS_TOKEN = os.environ.get("WA_REPORTING_METRICS_TOKEN")
+
+# The report being run, used to tag API calls. Set by the report task wrapper
+# and carried into fan-out worker threads with contextvars.copy_context().
+current_report = contextvars.ContextVar("current_report", default="none")
+
+API_COUNTERS = {
+    "wa_api_calls_total": "API calls (a paginated call counts once).",
+    "wa_api_call_seconds_total": "Wall time spent in API calls.",
+    "wa_api_pages_total": "Response pages fetched.",
+    "wa_api_bytes_total": "Response body bytes received.",
+    "wa_api_retries_total": "Requests retried after a 429.",
+    "wa_api_throttled_total": "429 responses received.",
+    "wa_api_throttle_wait_seconds_total": "Time spent waiting on the rate limiter.",
+    "wa_api_token_refreshes_total": "Token refreshes caused by a 401.",
+}
+REPORT_COUNTERS = {
+    "wa_report_runs_total": "Report runs completed.",
+    "wa_report_failures_total": "Report runs that raised an exception.",
+    "wa_report_seconds_total": "Wall time spent running reports.",
+}
+
+_lock = threading.Lock()
+_values = {}  # (metric name, labels tuple) -> value
+
+
+def _add(name, labels, amount):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _values[key] = _values.get(key, 0) + amount
+
+
+class CallStats:
+    """Accumulates the numbers for one call_api call; record() publishes them."""
+
+    def __init__(self, category):
+        self.category = category
+        self.report = current_report.get()
+        self.started = time.monotonic()
+        self.pages = 0
+        self.bytes = 0
+        self.retries = 0
+        self.throttled = 0
+        self.throttle_wait = 0.0
+        self.token_refreshes = 0
+        self._lock = threading.Lock()
+
+    def add(self, name, amount=1):
+        # Pages of one call may be fetched from several threads
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def record(self):
+        labels = {"category": self.category, "report": self.report}
+        elapsed = time.monotonic() - self.started
+        _add("wa_api_calls_total", labels, 1)
+        _add("wa_api_call_seconds_total", labels, elapsed)
+        _add("wa_api_pages_total", labels, self.pages)
+        _add("wa_api_bytes_total", labels, self.bytes)
+        _add("wa_api_retries_total", labels, self.retries)
+        _add("wa_api_throttled_total", labels, self.throttled)
+        _add("wa_api_throttle_wait_seconds_total", labels, self.throttle_wait)
+        _add("wa_api_token_refreshes_total", labels, self.token_refreshes)
+        logger.debug(f"API call {self.category} for report {self.report}: {elapsed:.2f}s, {self.pages} pages, "
+                     f"{self.bytes} bytes, {self.retries} retries, {self.token_refreshes} token refreshes")
+
+
+def run_report(name, fn, *args, **kwargs):
+    """Run a report function with its API calls tagged by name, recording its duration."""
+    # Reset afterwards, so later work on the same executor thread isn't tagged with this report
+    token = current_report.set(name)
+    started = time.monotonic()
+    try:
+        return fn(*args, **kwargs)
+    except BaseException:
+        _add("wa_report_failures_total", {"report": name}, 1)
+        raise
+    finally:
+        _add("wa_report_runs_total", {"report": name}, 1)
+        _add("wa_report_seconds_total", {"report": name}, time.monotonic() - started)
+        current_report.reset(token)
+
+
+class lazy_json:
+    """Pretty-prints data as JSON only if the log record is actually emitted.
+
+    Use as logger.debug("%s", lazy_json(data)); an f-string would serialize
+    the payload even when debug logging is off.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return json.dumps(self.data, indent=4, default=_json_default)
+
+
+def _json_default(value):
+    # Decoded records (records.py) and their dates
+    if hasattr(value, '__slots__'):
+        return {name: getattr(value, name) for name in value.__slots__}
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def render():
+    """Return all metrics in Prometheus text exposition format."""
+    with _lock:
+        values = dict(_values)
+    lines = []
+    for name, help_text in list(API_COUNTERS.items()) + list(REPORT_COUNTERS.items()):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for (metric, labels), value in sorted(values.items()):
+            if metric == name:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+    for key, value in ratelimit.stats().items():
+        name = f"wa_ratelimit_{key}_total"
+        lines.append(f"# HELP {name} Rate limiter {key.replace('_', ' ')} in this process.")
+        lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+@metrics_blueprint.route("/metrics")
+def metrics():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return Response("Unauthorized\n", status=401, mimetype="text/plain")
+    return Response(render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+import click
+
+import localstore
+import wadata
+
+logger = logging.getLogger(__name__)
+
+# A local SQLite copy of the Contacts, Events and EventRegistrations the
+# reports read, so they can be answered without a full download each time.
+# The first sync pulls everything; after that only recent changes are pulled:
+#   - Contacts by their 'Profile last updated' timestamp
+#   - Events (which have no last-updated filter) by re-reading those that
+#     started in the last WA_MIRROR_EVENT_RESYNC_DAYS or are upcoming, along
+#     with their registrations
+# A full sync is repeated every WA_MIRROR_FULL_SYNC_DAYS to pick up deletions.
+# Events are only held from WA_MIRROR_EVENT_HISTORY_DAYS before the last full
+# sync; requests reaching further back must go to the API (see covers_events).
+ENABLED = os.environ.get("WA_MIRROR", "false").lower() in ("1", "true", "yes", "on")
+MAX_AGE = int(os.environ.get("WA_MIRROR_MAX_AGE", 900))  # seconds
+FULL_SYNC_DAYS = int(os.environ.get("WA_MIRROR_FULL_SYNC_DAYS", 7))
+EVENT_HISTORY_DAYS = int(os.environ.get("WA_MIRROR_EVENT_HISTORY_DAYS", 400))
+EVENT_RESYNC_DAYS = int(os.environ.get("WA_MIRROR_EVENT_RESYNC_DAYS", 14))
+
+# How long one worker may hold the sync lease before another may take over.
+# A running sync renews its lease every third of this, so a long full sync
+# keeps it, while a worker that dies mid-sync loses it.
+SYNC_LEASE_SECONDS = 30 * 60
+
+DATASETS = ("contacts", "events")
+
+_conn = None
+_conn_lock = threading.Lock()
+
+
+def _connect():
+    global _conn
+    with _conn_lock:
+        if _conn is None:
+            _conn = localstore.connect("mirror.sqlite3")
+            _conn.executescript("""
+                CREATE TABLE IF NOT EXISTS contacts (id INTEGER PRIMARY KEY, data TEXT);
+                CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, start_date TEXT, data TEXT);
+                CREATE INDEX IF NOT EXISTS events_start_date ON events (start_date);
+                CREATE TABLE IF NOT EXISTS registrations (id INTEGER PRIMARY KEY, event_id INTEGER, data TEXT);
+                CREATE INDEX IF NOT EXISTS registrations_event_id ON registrations (event_id);
+                CREATE TABLE IF NOT EXISTS sync_state (dataset TEXT PRIMARY KEY, last_sync REAL,
+                    last_full_sync REAL, sync_started TEXT, leased_until REAL, covers_from TEXT);
+            """)
+        return _conn
+
+
+def _state(dataset):
+    row = _connect().execute(
+        "SELECT last_sync, last_full_sync, sync_started FROM sync_state WHERE dataset = ?", (dataset,)
+    ).fetchone()
+    return row or (None, None, None)
+
+
+def _claim(dataset):
+    """Take the sync lease for a dataset. Returns False if another worker is syncing it."""
+    conn = _connect()
+    now = time.time()
+    conn.execute("INSERT OR IGNORE INTO sync_state (dataset, leased_until) VALUES (?, 0)", (dataset,))
+    claimed = conn.execute(
+        "UPDATE sync_state SET leased_until = ? WHERE dataset = ? AND leased_until < ?",
+        (now + SYNC_LEASE_SECONDS, dataset, now),
+    ).rowcount
+    return claimed == 1
+
+
+def _release(dataset, started, full):
+    conn = _connect()
+    now = time.time()
+    if started is None:
+        conn.execute("UPDATE sync_state SET leased_until = 0 WHERE dataset = ?", (dataset,))
+    elif full:
+        conn.execute("UPDATE sync_state SET leased_until = 0, last_sync = ?, last_full_sync = ?, sync_started = ? "
+                     "WHERE dataset = ?", (now, now, started, dataset))
+    else:
+        conn.execute("UPDATE sync_state SET leased_until = 0, last_sync = ?, sync_started = ? "
+                     "WHERE dataset = ?", (now, started, dataset))
+
+
+class _LeaseRenewer:
+    """Extends a dataset's sync lease in the background while the sync runs."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"mirror-lease-{dataset}", daemon=True)
+
+    def _run(self):
+        # Its own connection, so renewals never land inside the sync's transaction
+        conn = localstore.connect("mirror.sqlite3")
+        try:
+            while not self._stop.wait(SYNC_LEASE_SECONDS / 3):
+                conn.execute("UPDATE sync_state SET leased_until = ? WHERE dataset = ? AND leased_until > 0",
+                             (time.time() + SYNC_LEASE_SECONDS, self.dataset))
+        finally:
+            conn.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def _insert(conn, table, rows):
+    if table == "events":
+        conn.executemany("INSERT OR REPLACE INTO events VALUES (?, ?, ?)",
+                         [(row['Id'], row.get('StartDate'), json.dumps(row)) for row in rows])
+    elif table == "registrations":
+        conn.executemany("INSERT OR REPLACE INTO registrations VALUES (?, ?, ?)",
+                         [(row['Id'], row.get('Event', {}).get('Id'), json.dumps(row)) for row in rows])
+    else:
+        conn.executemany("INSERT OR REPLACE INTO contacts VALUES (?, ?)",
+                         [(row['Id'], json.dumps(row)) for row in rows])
+
+
+def _replace(clear, inserts):
+    """Run the clear statements [(sql, params)] and the inserts [(table, rows)] as one transaction.
+
+    Everything is fetched before this is called, so readers in other workers
+    see either the old data or the new, never a half-written mirror.
+    """
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for sql, params in clear:
+            conn.executemany(sql, params)
+        for table, rows in inserts:
+            _insert(conn, table, rows)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _sync_contacts(full, started_before):
+    if full or started_before is None:
+        since = "1900-01-01T00:00:00"
+    else:
+        since = started_before
+    filter_string = f"'Profile last updated' ge {since}"
+    contacts = wadata.call_api("Contacts", filter_string=filter_string, cache=False, parallel=True)['Contacts']
+    _replace([("DELETE FROM contacts", [()])] if full else [], [("contacts", contacts)])
+    logger.info(f"Mirror synced {len(contacts)} contacts ({'full' if full else 'incremental'}).")
+
+
+def _sync_events(full):
+    days = EVENT_HISTORY_DAYS if full else EVENT_RESYNC_DAYS
+    since = (datetime.today() - timedelta(days=days)).strftime('%Y-%m-%d')
+    events = wadata.call_api("Events", filter_string=f"StartDate ge {since}", cache=False)['Events']
+    event_ids = [event['Id'] for event in events]
+    registrations = wadata.call_api_many("EventRegistrations", event_ids, cache=False)
+
+    if full:
+        clear = [("DELETE FROM events", [()]), ("DELETE FROM registrations", [()]),
+                 ("UPDATE sync_state SET covers_from = ? WHERE dataset = 'events'", [(since,)])]
+    else:
+        # Registrations can be deleted, so replace each event's set wholesale
+        clear = [("DELETE FROM registrations WHERE event_id = ?", [(event_id,) for event_id in event_ids])]
+    _replace(clear, [("events", events),
+                     ("registrations", [entry for event_registrations in registrations
+                                        for entry in event_registrations])])
+    logger.info(f"Mirror synced {len(events)} events since {since} ({'full' if full else 'incremental'}).")
+
+
+def sync(dataset, full=False):
+    """Bring one dataset up to date. Returns False if another worker is already syncing it."""
+    if not _claim(dataset):
+        logger.info(f"Mirror {dataset} sync already in progress elsewhere.")
+        return False
+    last_sync, last_full_sync, sync_started = _state(dataset)
+    if last_full_sync is None or time.time() - last_full_sync > FULL_SYNC_DAYS * 86400:
+        full = True
+    # Record the start time before fetching, so changes made during the sync
+    # are picked up next time
+    started = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    try:
+        with _LeaseRenewer(dataset):
+            if dataset == "contacts":
+                _sync_contacts(full, sync_started)
+            else:
+                _sync_events(full)
+    except BaseException:
+        _release(dataset, None, full)
+        raise
+    _release(dataset, started, full)
+    return True
+
+
+def ensure_fresh(dataset, max_age=MAX_AGE):
+    """Sync the dataset if it has never been synced or is older than max_age seconds."""
+    last_sync = _state(dataset)[0]
+    if last_sync is None or time.time() - last_sync > max_age:
+        sync(dataset)
+        if _state(dataset)[0] is None:
+            raise Exception(f"Local {dataset} mirror is still being populated, please try again shortly.")
+
+
+def contacts():
+    ensure_fresh("contacts")
+    return [json.loads(row[0]) for row in _connect().execute("SELECT data FROM contacts")]
+
+
+def covers_events(start_after):
+    """Whether the mirror holds every event starting on or after start_after (YYYY-MM-DD, or None for all)."""
+    ensure_fresh("events")
+    row = _connect().execute("SELECT covers_from FROM sync_state WHERE dataset = 'events'").fetchone()
+    return start_after is not None and row is not None and row[0] is not None and start_after >= row[0]
+
+
+def events(start_after=None):
+    """Mirrored events, optionally only those starting after the given YYYY-MM-DD date."""
+    ensure_fresh("events")
+    if start_after is None:
+        rows = _connect().execute("SELECT data FROM events ORDER BY start_date")
+    else:
+        rows = _connect().execute("SELECT data FROM events WHERE start_date > ? ORDER BY start_date",
+                                  (start_after,))
+    return [json.loads(row[0]) for row in rows]
+
+
+def registrations(event_ids):
+    """Mirrored registrations for each of event_ids, as lists in the same order."""
+    ensure_fresh("events")
+    event_ids = list(event_ids)
+    by_event = {event_id: [] for event_id in event_ids}
+    conn = _connect()
+    # Stay well under SQLite's limit on query parameters
+    for i in range(0, len(event_ids), 500):
+        chunk = event_ids[i:i + 500]
+        rows = conn.execute(f"SELECT event_id, data FROM registrations WHERE event_id IN "
+                            f"({', '.join('?' * len(chunk))}) ORDER BY id", chunk)
+        for event_id, data in rows:
+            by_event[event_id].append(json.loads(data))
+    return [by_event[event_id] for event_id in event_ids]
+
+
+@click.command("mirror-sync")
+@click.option("--full", is_flag=True, help="Re-download everything instead of recent changes.")
+def sync_command(full):
+    """Sync the local Contacts and Events mirror from Wild Apricot."""
+    for dataset in DATASETS:
+        sync(dataset, full=full)
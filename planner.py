@@ -0,0 +1,144 @@
+import logging
+
+import metrics
+import mirror
+import records as record_types
+import wadata
+
+logger = logging.getLogger(__name__)
+
+# Reports declare the records they need as Needs instead of calling the API
+# themselves. fetch() groups the needs of one or more reports so each dataset
+# is fetched once: Events needs are merged into a single date-range query,
+# and Contacts needs with the same filter share one query. Each need then
+# gets its own slice of the records, selected locally with its predicate.
+# Records are handed out decoded (see records.py), so predicates and reports
+# work with attributes rather than JSON dicts.
+
+
+class Need:
+    """Records one report needs from a Wild Apricot category.
+
+    filter_string is the exact API filter, used when this need is fetched on
+    its own (or with others sharing the same filter). predicate must select
+    the same records locally; it is used when Events needs are merged into
+    one query, and with the local mirror. start_after is the filter's date
+    bound, which the planner applies itself: Events starting on or after that
+    YYYY-MM-DD date. predicate_fields are extra fields the predicate reads.
+    """
+
+    def __init__(self, category, fields, filter_string=None, predicate=None, start_after=None,
+                 predicate_fields=()):
+        self.category = category
+        self.fields = list(fields)
+        self.filter_string = filter_string
+        self.predicate = predicate
+        self.start_after = start_after
+        self.predicate_fields = list(predicate_fields)
+
+    def query_fields(self):
+        """The fields to fetch for a merged query: those the report uses, plus those matches() reads."""
+        fields = list(self.fields)
+        for field in self.predicate_fields + (['StartDate'] if self.start_after is not None else []):
+            if field not in fields:
+                fields.append(field)
+        return fields
+
+    def matches(self, record):
+        if self.start_after is not None and (record.start is None
+                                             or record.start.date().isoformat() < self.start_after):
+            return False
+        return self.predicate is None or self.predicate(record)
+
+
+def _group_key(need):
+    # All Events needs share a query; other categories only when the filter is the same
+    if need.category == "Events":
+        return ("Events", None)
+    return (need.category, need.filter_string)
+
+
+def plan(needs):
+    """Group needs ({name: Need}) into queries, as a list of (category, [(name, Need)])."""
+    groups = {}
+    for name, need in needs.items():
+        groups.setdefault(_group_key(need), []).append((name, need))
+    return [(category, members) for (category, _), members in groups.items()]
+
+
+def _merged_query(category, members):
+    """Return the filter and fields of one query covering every need in members."""
+    fields = []
+    for _, need in members:
+        for field in need.query_fields():
+            if field not in fields:
+                fields.append(field)
+    # Events: everything since the earliest start date; the rest is filtered locally
+    if any(need.start_after is None for _, need in members):
+        return None, fields
+    return f"StartDate ge {min(need.start_after for _, need in members)}", fields
+
+
+def _fetch_mirror(category, members):
+    if category == "Events":
+        starts = [need.start_after for _, need in members]
+        start_after = None if None in starts else min(starts)
+        if not mirror.covers_events(start_after):
+            logger.info(f"The mirror does not hold events since {start_after}, fetching them from the API.")
+            return None
+        return mirror.events(start_after=start_after)
+    if category == "Contacts":
+        return mirror.contacts()
+    return None
+
+
+def _stream(category, need, refresh):
+    """Decode the need's records as each page arrives, so the whole collection is never held."""
+    record_type = record_types.TYPES[category]
+    for record in wadata.iter_api(category, filter_string=need.filter_string, parallel=True, fields=need.fields,
+                                  refresh=refresh):
+        yield record_type(record)
+
+
+def fetch(needs, live=False):
+    """Fetch the records for needs ({name: Need}), each dataset once. Returns {name: records}.
+
+    The records are decoded into the types in records.py. They are a list,
+    except for a need fetched from the API on its own in a category other
+    than Events (e.g. Contacts): that gets an iterator that streams the
+    records as the pages arrive, and can be read once.
+
+    Uses the local mirror when it is enabled and has the category, unless
+    live, which also skips the API response cache.
+    """
+    results = {}
+    for category, members in plan(needs):
+        # exact: fetched with the needs' own filter, so there is nothing to select locally
+        records = _fetch_mirror(category, members) if mirror.ENABLED and not live else None
+        exact = False
+        if records is not None:
+            logger.debug(f"{category} for {', '.join(str(name) for name, _ in members)} read from the mirror.")
+        elif len(members) == 1 and category != "Events":
+            name, need = members[0]
+            results[name] = _stream(category, need, live)
+            continue
+        elif len(members) == 1 or category != "Events":
+            fields = []
+            for _, need in members:
+                fields.extend(field for field in need.fields if field not in fields)
+            records = wadata.call_api(category, filter_string=members[0][1].filter_string, parallel=True,
+                                      fields=fields, refresh=live)[category]
+            exact = True
+        else:
+            filter_string, fields = _merged_query(category, members)
+            logger.info(f"Fetching {category} once for {len(members)} needs with filter {filter_string}.")
+            records = wadata.call_api(category, filter_string=filter_string, parallel=True,
+                                      fields=fields, refresh=live)[category]
+        logger.debug("%s records: %s", category, metrics.lazy_json(records))
+        # Decode once; every need in the group shares the same record objects
+        record_type = record_types.TYPES[category]
+        records = [record_type(record) for record in records]
+
+        for name, need in members:
+            results[name] = records if exact else [record for record in records if need.matches(record)]
+    return results
@@ -0,0 +1,77 @@
+import threading
+import contextvars
+
+# Progress of the report task running in the current context. The report task
+# wrapper sets it; wadata and the reports update it as work gets done, and the
+# task_status endpoint long-polls it. Fan-out worker threads inherit it through
+# contextvars.copy_context().
+current = contextvars.ContextVar("report_progress", default=None)
+
+
+class Progress:
+    """Counters describing how far a report task has got, with change notification."""
+
+    def __init__(self, listener=None):
+        # listener(snapshot, force) is called after each update, e.g. to save
+        # progress where other workers can see it; force is set when finished
+        self._listener = listener
+        self._changed = threading.Condition()
+        self.version = 0
+        self.pages = 0
+        self.completed = 0
+        self.total = None
+        self.label = None
+        self.finished = False
+
+    def update(self, pages=0, completed=0, total=None, label=None, finished=False):
+        with self._changed:
+            self.pages += pages
+            self.completed += completed
+            if total is not None:
+                self.total = total
+                self.completed = 0
+            if label is not None:
+                self.label = label
+            self.finished = self.finished or finished
+            self.version += 1
+            self._changed.notify_all()
+            snapshot = self._snapshot()
+        if self._listener is not None:
+            self._listener(snapshot, self.finished)
+
+    def snapshot(self):
+        with self._changed:
+            return self._snapshot()
+
+    def _snapshot(self):
+        return {
+            "version": self.version,
+            "pages": self.pages,
+            "completed": self.completed,
+            "total": self.total,
+            "label": self.label,
+        }
+
+    def wait(self, since, timeout):
+        """Wait up to timeout seconds for a change after version `since`."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != since or self.finished, timeout)
+
+
+def page_fetched():
+    progress = current.get()
+    if progress is not None:
+        progress.update(pages=1)
+
+
+def start_stage(total, label):
+    """Start counting `total` units of work, e.g. start_stage(120, "events checked")."""
+    progress = current.get()
+    if progress is not None:
+        progress.update(total=total, label=label)
+
+
+def advance(count=1):
+    progress = current.get()
+    if progress is not None:
+        progress.update(completed=count)
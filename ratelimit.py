@@ -0,0 +1,288 @@
+import os
+import time
+import asyncio
+import random
+import logging
+import sqlite3
+import threading
+from email.utils import parsedate_to_datetime
+
+import localstore
+
+logger = logging.getLogger(__name__)
+
+# Wild Apricot throttles API calls per account, so every thread and every
+# worker process shares one token bucket. The bucket lives in SQLite when
+# WA_API_RATE_LIMIT_SHARED is on (the default), otherwise in process memory.
+RATE = float(os.environ.get("WA_API_RATE", 2.0))  # requests per second
+MIN_RATE = float(os.environ.get("WA_API_MIN_RATE", 0.2))
+BURST = float(os.environ.get("WA_API_BURST", 5))
+MAX_RETRIES = int(os.environ.get("WA_API_MAX_RETRIES", 5))
+BACKOFF_BASE = float(os.environ.get("WA_API_BACKOFF_BASE", 1.0))  # seconds
+BACKOFF_MAX = float(os.environ.get("WA_API_BACKOFF_MAX", 60.0))  # seconds
+SHARED = os.environ.get("WA_API_RATE_LIMIT_SHARED", "true").lower() in ("1", "true", "yes", "on")
+
+# After a 429 the rate is halved; every successful call wins back this much.
+RATE_RECOVERY_STEP = RATE / 50
+
+STATE_DB = "ratelimit.sqlite3"
+
+
+class TokenBucket:
+    """Adaptive token bucket, coordinated across threads and (optionally) processes.
+
+    The bucket refills at `rate` tokens per second up to `burst`. A 429 from the
+    API halves the rate and blocks everyone until the Retry-After time has
+    passed; each success nudges the rate back up towards its configured value.
+    """
+
+    def __init__(self, rate=RATE, burst=BURST, min_rate=MIN_RATE, shared=SHARED):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._state = {"tokens": burst, "updated": time.time(), "rate": rate, "blocked_until": 0.0}
+        self._rate_seen = rate
+        self._conn = None
+        if shared:
+            try:
+                self._conn = localstore.connect(STATE_DB)
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS bucket (id INTEGER PRIMARY KEY CHECK (id = 1), "
+                    "tokens REAL, updated REAL, rate REAL, blocked_until REAL)"
+                )
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO bucket VALUES (1, ?, ?, ?, 0)", (burst, time.time(), rate)
+                )
+            except (sqlite3.Error, OSError) as e:
+                logger.warning(f"Unable to open shared rate limit state, limiting per process only: {e}")
+                self._conn = None
+
+    def _update(self, fn):
+        """Apply fn to the bucket state atomically and return its result."""
+        with self._lock:
+            if self._conn is None:
+                return fn(self._state)
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT tokens, updated, rate, blocked_until FROM bucket WHERE id = 1"
+                ).fetchone()
+                state = dict(zip(("tokens", "updated", "rate", "blocked_until"), row))
+                result = fn(state)
+                self._conn.execute(
+                    "UPDATE bucket SET tokens = ?, updated = ?, rate = ?, blocked_until = ? WHERE id = 1",
+                    (state["tokens"], state["updated"], state["rate"], state["blocked_until"]),
+                )
+                self._conn.execute("COMMIT")
+                return result
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def reserve(self):
+        """Take a token if one is available. Returns 0, or the seconds to wait before trying again."""
+
+        def take(state):
+            now = time.time()
+            state["tokens"] = min(self.burst, state["tokens"] + (now - state["updated"]) * state["rate"])
+            state["updated"] = now
+            self._rate_seen = state["rate"]
+            if now < state["blocked_until"]:
+                return state["blocked_until"] - now
+            if state["tokens"] >= 1:
+                state["tokens"] -= 1
+                return 0
+            return (1 - state["tokens"]) / state["rate"]
+
+        return self._update(take)
+
+    def acquire(self):
+        """Block until a request may be sent. Returns the number of seconds spent waiting."""
+        waited = 0.0
+        while True:
+            delay = self.reserve()
+            if delay <= 0:
+                if waited:
+                    _count("wait_seconds", waited)
+                return waited
+            # Add a little jitter so waiting threads don't all wake at once.
+            delay = delay + random.uniform(0, 0.1)
+            time.sleep(delay)
+            waited += delay
+
+    async def _off_loop(self, fn, *args):
+        # Shared state is read and written in SQLite, which must not block the event loop
+        if self._conn is None:
+            return fn(*args)
+        return await asyncio.to_thread(fn, *args)
+
+    async def acquire_async(self):
+        """Like acquire, but sleeps without blocking the event loop."""
+        waited = 0.0
+        while True:
+            delay = await self._off_loop(self.reserve)
+            if delay <= 0:
+                if waited:
+                    _count("wait_seconds", waited)
+                return waited
+            delay = delay + random.uniform(0, 0.1)
+            await asyncio.sleep(delay)
+            waited += delay
+
+    def throttled(self, delay):
+        """Record a 429: halve the rate and hold all callers off for delay seconds."""
+
+        def penalize(state):
+            now = time.time()
+            state["tokens"] = 0
+            state["updated"] = now
+            state["rate"] = max(self.min_rate, state["rate"] / 2)
+            state["blocked_until"] = max(state["blocked_until"], now + delay)
+            self._rate_seen = state["rate"]
+            return state["rate"]
+
+        rate = self._update(penalize)
+        logger.info(f"API throttled, backing off {delay:.1f}s, rate is now {rate:.2f}/s")
+
+    def succeeded(self):
+        """Record a successful call, recovering the rate after earlier throttling."""
+        if self._rate_seen >= self.max_rate:
+            return
+
+        def recover(state):
+            state["rate"] = min(self.max_rate, state["rate"] + RATE_RECOVERY_STEP)
+            self._rate_seen = state["rate"]
+
+        self._update(recover)
+
+    async def throttled_async(self, delay):
+        """Like throttled, without blocking the event loop."""
+        await self._off_loop(self.throttled, delay)
+
+    async def succeeded_async(self):
+        """Like succeeded, without blocking the event loop."""
+        if self._rate_seen < self.max_rate:
+            await self._off_loop(self.succeeded)
+
+
+def retry_after_seconds(response):
+    """Parse a Retry-After header (seconds or HTTP date). Returns None if absent or unparseable."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Jittered exponential backoff; Retry-After from the server wins when present."""
+    if retry_after is not None:
+        return min(BACKOFF_MAX, retry_after) + random.uniform(0, BACKOFF_BASE)
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+_counters_lock = threading.Lock()
+_counters = {
+    "requests": 0,
+    "throttled": 0,
+    "retries": 0,
+    "gave_up": 0,
+    "wait_seconds": 0.0,
+}
+
+
+def _count(name, amount=1):
+    with _counters_lock:
+        _counters[name] += amount
+
+
+def stats():
+    """Return a snapshot of this process's rate limiting counters."""
+    with _counters_lock:
+        return dict(_counters)
+
+
+_bucket = None
+_bucket_lock = threading.Lock()
+
+
+def get_bucket():
+    global _bucket
+    with _bucket_lock:
+        if _bucket is None:
+            _bucket = TokenBucket()
+        return _bucket
+
+
+def send(request_fn, stats=None):
+    """Send a request through the shared limiter, retrying 429 responses.
+
+    request_fn is called with no arguments and must return a requests.Response.
+    The last response is returned once it is not a 429 or the retry budget
+    (WA_API_MAX_RETRIES) is used up. Waits and retries are also added to stats,
+    a metrics.CallStats, if given.
+    """
+    bucket = get_bucket()
+    attempt = 0
+    while True:
+        waited = bucket.acquire()
+        _count("requests")
+        if stats is not None:
+            stats.add("throttle_wait", waited)
+        response = request_fn()
+        if response.status_code != 429:
+            bucket.succeeded()
+            return response
+
+        _count("throttled")
+        if stats is not None:
+            stats.add("throttled")
+        if attempt >= MAX_RETRIES:
+            _count("gave_up")
+            logger.warning(f"API still throttled after {attempt} retries, giving up")
+            return response
+
+        delay = backoff_delay(attempt, retry_after_seconds(response))
+        bucket.throttled(delay)
+        _count("retries")
+        if stats is not None:
+            stats.add("retries")
+        attempt += 1
+
+
+async def send_async(request_fn, stats=None):
+    """Async version of send; request_fn returns an awaitable response (e.g. from httpx)."""
+    bucket = get_bucket()
+    attempt = 0
+    while True:
+        waited = await bucket.acquire_async()
+        _count("requests")
+        if stats is not None:
+            stats.add("throttle_wait", waited)
+        response = await request_fn()
+        if response.status_code != 429:
+            await bucket.succeeded_async()
+            return response
+
+        _count("throttled")
+        if stats is not None:
+            stats.add("throttled")
+        if attempt >= MAX_RETRIES:
+            _count("gave_up")
+            logger.warning(f"API still throttled after {attempt} retries, giving up")
+            return response
+
+        delay = backoff_delay(attempt, retry_after_seconds(response))
+        await bucket.throttled_async(delay)
+        _count("retries")
+        if stats is not None:
+            stats.add("retries")
+        attempt += 1
@@ -0,0 +1,74 @@
+from datetime import datetime
+
+# Compact records for the API objects the reports work with. They are decoded
+# once, as the data is fetched, keeping only the fields the reports read, with
+# dates parsed and flags such as "cancelled" worked out up front, so the
+# reports don't repeat that work per row. __slots__ keeps them much smaller
+# than the JSON dicts they replace.
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+CANCEL_WORDS = ['cancelled', 'canceled', 'cancellled', 'cancselled', 'canelled', 'cancel']
+
+
+def parse_date(value):
+    """Parse an API timestamp such as 2024-01-31T18:00:00-05:00, or return None."""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return datetime.strptime(value, DATE_FORMAT)
+
+
+class Event:
+    __slots__ = ('id', 'name', 'start', 'end', 'tags', 'confirmed_registrations', 'registrations_limit',
+                 'cancelled')
+
+    def __init__(self, record):
+        self.id = record['Id']
+        self.name = record['Name']
+        self.start = parse_date(record.get('StartDate'))
+        self.end = parse_date(record.get('EndDate'))
+        self.tags = record.get('Tags') or []
+        self.confirmed_registrations = record.get('ConfirmedRegistrationsCount')
+        self.registrations_limit = record.get('RegistrationsLimit')
+        name = self.name.lower()
+        self.cancelled = any(word in name for word in CANCEL_WORDS)
+
+
+class Registration:
+    __slots__ = ('id', 'display_name', 'is_instructor', 'checked_in', 'instructor_missing')
+
+    def __init__(self, record):
+        self.id = record.get('Id')
+        self.display_name = record['DisplayName']
+        # RegistrationTypeId does not work, not all instructor registrations use the same id number! grr
+        self.is_instructor = 'Instructor' in record['RegistrationType']['Name']
+        self.checked_in = record['IsCheckedIn']
+        self.instructor_missing = self.is_instructor and self.checked_in == False  # noqa: E712 (None is not missing)
+
+
+class Contact:
+    __slots__ = ('id', 'email', 'email_key', 'membership_enabled', 'membership_level_id', 'status')
+
+    def __init__(self, record):
+        self.id = record.get('Id')
+        self.email = record.get('Email')
+        # Emails are compared case-insensitively, ignoring stray whitespace
+        self.email_key = self.email.strip().lower() if self.email is not None else None
+        self.membership_enabled = record.get('MembershipEnabled')
+        self.membership_level_id = (record.get('MembershipLevel') or {}).get('Id')
+        self.status = record.get('Status')
+
+
+def registrations(records):
+    """Decode one event's registrations (the decode hook for wadata.call_api_many)."""
+    return [Registration(record) for record in records]
+
+
+# Record type for each category the planner decodes
+TYPES = {
+    'Events': Event,
+    'EventRegistrations': Registration,
+    'Contacts': Contact,
+}
@@ -1,17 +1,59 @@
-from flask import Blueprint, session, redirect, url_for, render_template, request, current_app, flash
+from flask import (Blueprint, session, redirect, url_for, render_template, request, current_app, flash, jsonify,
+                   Response)
 from flask_executor import Executor
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import logging
+import hashlib
+import inspect
+import json
+import sys
+import threading
+import time
+import apicache
 import auth
+import exports
+import jobs
+import metrics
+import mirror
+import planner
+import progress
+import records
+import snapshots
+import verdicts
 import wadata
-import json
-import random
-import pandas as pd
 
 logger = logging.getLogger(__name__)
 
 reports_blueprint = Blueprint('reports', __name__)
-executor = None
+# Guards creating the flask_executor pools (see get_executor and wareporting.py)
+_executors_lock = threading.Lock()
+
+# The record fields each report reads. Only these are requested from the API
+# (where it supports $select) and kept in memory; see wadata.call_api.
+MISSING_CHECKINS_EVENT_FIELDS = ['Id', 'Name', 'StartDate']
+MISSING_CHECKINS_REGISTRATION_FIELDS = ['DisplayName', 'RegistrationType', 'IsCheckedIn']
+SLACK_ORPHANS_CONTACT_FIELDS = ['Email']
+MAKERSCHOOL_EVENT_FIELDS = ['Id', 'Name', 'ConfirmedRegistrationsCount', 'RegistrationsLimit', 'StartDate', 'EndDate']
+
+# Slack exports are read in chunks of this many rows, keeping only the columns
+# we use, so large workspaces are processed in bounded memory.
+SLACK_COLUMNS = ['username', 'email', 'fullname', 'status']
+SLACK_CSV_CHUNK_ROWS = 5000
+# Exports with at least this many users are matched in the "cpu" process pool
+SLACK_PROCESS_POOL_MIN_ROWS = 20000
+
+# Date-range reports look back this many days unless asked otherwise
+DEFAULT_DELTA_DAYS = 31
+
+# The executor pool each report runs in. Reports that fan out over many API
+# calls share the "reports" pool; quick ones get the "quick" pool so they
+# never queue behind a long fan-out. Anything not listed runs in "reports".
+REPORT_POOLS = {
+    'get_missing_instructor_checkins': 'reports',
+    'get_slack_orphans': 'reports',
+    'get_makerschool_registrations': 'quick',
+    'get_all_dashboards': 'reports',
+}
 
 
 # All routes in this blueprint require an active login
@@ -28,11 +70,14 @@ def require_login():
         logger.info(f"User token not found in session, redirecting to login.")
         return redirect(url_for('auth.login'))
 
-    # confirm that they have the right signoff    
-    if 'report_access' not in session:
+    # confirm that they have the right signoff, rechecking (against the shared
+    # access cache) once the session's answer is older than the access TTL
+    if ('report_access' not in session
+            or time.time() - session.get('report_access_checked_at', 0) > auth.WA_REPORTING_ACCESS_TTL):
         logger.info(f"User report access not determined, checking.")
         try:
             session['report_access'] = auth.check_report_access()
+            session['report_access_checked_at'] = time.time()
         except Exception as e:
             logger.error(f"Error checking report access: {e}")
             return f"""Error checking report access. Please try again. 
@@ -46,125 +91,446 @@ def require_login():
 
 @reports_blueprint.route("/")
 def index():
-    return render_template("catalog.jinja")
+    return render_template("catalog.jinja", mirror_enabled=mirror.ENABLED)
+
+
+# Report tasks are recorded in the job store (see jobs.py), shared by every
+# worker process. Identical requests (same report, same arguments) share one
+# task while it is in progress, and reuse its result for REPORT_REUSE_SECONDS
+# after it finishes, so several people opening the same report don't each
+# start a fan-out against the API. Results are kept for
+# REPORT_RESULT_KEEP_SECONDS whether or not anyone collected them.
+#
+# Progress of the tasks running in this process, by task id. Status polls that
+# land on this process wait on these directly; other workers poll the store.
+_local_runs = {}
+_local_runs_lock = threading.Lock()
+
+# Longest a task_status request may be held open waiting for progress. Each
+# waiting request holds a server thread, hence gunicorn's threaded workers
+# (see gunicorn.conf.py).
+TASK_STATUS_MAX_WAIT = 25
+# How often task_status checks the store for tasks running in another worker
+TASK_STATUS_POLL_INTERVAL = 0.5
+
+
+def _normalize_argument(value):
+    # A DataFrame argument means pandas is loaded already; don't import it just to check
+    pd = sys.modules.get('pandas')
+    if pd is not None and isinstance(value, pd.DataFrame):
+        # Identify uploads by content rather than by object
+        digest = hashlib.sha1(pd.util.hash_pandas_object(value, index=False).values.tobytes())
+        digest.update(",".join(map(str, value.columns)).encode("utf-8"))
+        return f"DataFrame:{digest.hexdigest()}"
+    return value
+
+
+def _report_key(processor_function, args, kwargs):
+    return json.dumps([processor_function.__name__,
+                       [_normalize_argument(arg) for arg in args],
+                       sorted((name, _normalize_argument(value)) for name, value in kwargs.items())],
+                      default=str)
+
+
+def get_executor(name):
+    """Return the app's named flask_executor pool, configured by {NAME}_EXECUTOR_* app settings.
+
+    Pools are created on first use, in the worker process, never in a
+    gunicorn --preload parent before it forks.
+    """
+    app = current_app._get_current_object()
+    with _executors_lock:
+        executor = app.extensions.get(f"{name}executor")
+        if executor is None:
+            executor = Executor(app, name=name)
+        return executor
+
+
+def _run_report_task(task_id, run_progress, max_result_bytes, refresh, processor_function, *args, **kwargs):
+    progress.current.set(run_progress)
+    # A recompute reads from the API, not the response cache
+    refreshing = apicache.refreshing.set(refresh)
+    # Tag the report's API calls in the metrics with its name
+    report_name = processor_function.__name__.removeprefix('get_')
+    try:
+        # Lets other workers tell this run from one that died with its worker
+        with jobs.Heartbeat(task_id):
+            result = metrics.run_report(report_name, processor_function, *args, **kwargs)
+    except Exception as e:
+        logger.exception(f"Report task {task_id} ({report_name}) failed.")
+        jobs.finish(task_id, error=str(e))
+    else:
+        jobs.finish(task_id, result=result, max_result_bytes=max_result_bytes)
+        _record_snapshots(processor_function, args, kwargs, result)
+    finally:
+        apicache.refreshing.reset(refreshing)
+        run_progress.update(finished=True)
+        with _local_runs_lock:
+            _local_runs.pop(task_id, None)
+
+
+def _snapshot_args(function, arguments):
+    """The arguments snapshots of a run of function are kept under, from its bound arguments.
+
+    start_date becomes delta_days, relative to today as the forms ask for it,
+    so daily runs line up. Uploaded data (a Slack export) is what the runs
+    compare, not an argument, so it is left out.
+    """
+    pd = sys.modules.get('pandas')
+    parameters = inspect.signature(function).parameters
+    args = {}
+    for name, value in arguments.items():
+        if name not in parameters:
+            continue
+        if name == 'start_date':
+            args['delta_days'] = (datetime.today() - datetime.strptime(value, '%Y-%m-%d')).days
+        elif pd is None or not isinstance(value, pd.DataFrame):
+            args[name] = value
+    return args
+
+
+def _record_snapshots(processor_function, args, kwargs, result):
+    bound = inspect.signature(processor_function).bind(*args, **kwargs)
+    bound.apply_defaults()
+    # "Run all dashboards" results are kept as snapshots of the reports they contain
+    if processor_function is get_all_dashboards:
+        parts = [(name, ALL_DASHBOARDS[name], part) for name, part in result.items()]
+    else:
+        parts = [(processor_function.__name__.removeprefix('get_'), processor_function, result)]
+    for name, function, part in parts:
+        try:
+            snapshots.record(name, part, _snapshot_args(function, bound.arguments))
+        except Exception:
+            logger.exception(f"Could not record a snapshot of {name}.")
 
 
 # Reports can be slow, so we need to process them asynchronously.
 #
-# This function starts processor_function as a background task and 
-# registers the task id with Flask.
+# This function starts processor_function as a background task, or attaches
+# to an identical one that is already running, and stores the task id in the
+# user's session.
 #
-def start_report_task(processor_function, *args, **kwargs):
-    global executor
+# Task results go through the job store as JSON, so report functions must
+# return JSON-serializable data (tuples come back as lists).
+#
+# A warm result for the same arguments (pre-warmed by the scheduler, no older
+# than PREWARM_MAX_AGE_SECONDS) is served instead of running the report, and
+# a finished run is reused for REPORT_REUSE_SECONDS; refresh=True skips both,
+# and the API response cache.
+#
+def start_report_task(processor_function, *args, refresh=False, **kwargs):
+    config = current_app.config
+    jobs.evict(config.get('REPORT_RESULT_KEEP_SECONDS', 3600), config.get('REPORT_RESULT_STORE_MAX_BYTES'),
+               config.get('PREWARM_MAX_AGE_SECONDS', 0))
+    key = _report_key(processor_function, args, kwargs)
+    # Lets the result page offer to recompute the same report
+    session["refresh_url"] = (url_for(request.endpoint, **{**request.args.to_dict(), 'refresh': '1'})
+                              if request.method == 'GET' else None)
+
+    task_id = None if refresh else jobs.find_warm(key, config.get('PREWARM_MAX_AGE_SECONDS', 0))
+    if task_id is not None:
+        logger.info(f"Serving warm result {task_id} for {processor_function.__name__}.")
+        session["task_id"] = task_id
+        return
 
-    # Start a long task
-    if executor is None:
-        executor = Executor(current_app._get_current_object())
-    task_id = random.randint(100000, 999999)
-    future = executor.submit_stored(task_id, processor_function, *args, **kwargs)
+    task_id, created = jobs.claim(key, processor_function.__name__,
+                                  0 if refresh else config.get('REPORT_REUSE_SECONDS', 0))
 
-    # Store the Future instance's unique identifier in the user's session
+    if not created:
+        logger.info(f"Reusing report task {task_id} for {processor_function.__name__}.")
+    else:
+        # Start a long task
+        executor = get_executor(REPORT_POOLS.get(processor_function.__name__, 'reports'))
+        run_progress = progress.Progress(listener=jobs.progress_writer(task_id))
+        with _local_runs_lock:
+            _local_runs[task_id] = run_progress
+        executor.submit(_run_report_task, task_id, run_progress, config.get('REPORT_RESULT_MAX_BYTES'), refresh,
+                        processor_function, *args, **kwargs)
+
+    # Store the task's unique identifier in the user's session
     session["task_id"] = task_id
 
     return
 
 
+def is_prewarmed(name, since):
+    """Whether report name (in PREWARM_REPORTS) has a warm result for today's default arguments finished since then."""
+    processor_function, default_arguments = PREWARM_REPORTS[name]
+    args, kwargs = default_arguments()
+    return jobs.find_warm(_report_key(processor_function, args, kwargs), time.time() - since) is not None
+
+
+def prewarm_report(name):
+    """Run a report in PREWARM_REPORTS now, with its default arguments, and keep the result warm.
+
+    Runs in the calling thread (the scheduler's), with an app context but no request.
+    """
+    config = current_app.config
+    processor_function, default_arguments = PREWARM_REPORTS[name]
+    args, kwargs = default_arguments()
+    jobs.evict(config.get('REPORT_RESULT_KEEP_SECONDS', 3600), config.get('REPORT_RESULT_STORE_MAX_BYTES'),
+               config.get('PREWARM_MAX_AGE_SECONDS', 0))
+    key = _report_key(processor_function, args, kwargs)
+    task_id, created = jobs.claim(key, processor_function.__name__, 0)
+    # Warm before running, so the run's own finish() records it
+    jobs.set_warm(key, task_id, name)
+    if not created:
+        logger.info(f"Not pre-warming {name}, it is already running as task {task_id}.")
+        return task_id
+
+    logger.info(f"Pre-warming {name} as task {task_id}.")
+    run_progress = progress.Progress(listener=jobs.progress_writer(task_id))
+    with _local_runs_lock:
+        _local_runs[task_id] = run_progress
+    _run_report_task(task_id, run_progress, config.get('REPORT_RESULT_MAX_BYTES'), False,
+                     processor_function, *args, **kwargs)
+    return task_id
+
+
+def _freshness(task_id):
+    """Values for report/freshness.jinja: when the result was computed, and how to recompute it."""
+    job = jobs.get(task_id) if task_id is not None else None
+    finished = job['finished'] if job is not None else None
+    return {'computed_at': datetime.fromtimestamp(finished).strftime('%Y-%m-%d %H:%M') if finished else None,
+            'refresh_url': session.get('refresh_url')}
+
+
 # Reports can be slow, so we need to process them asynchronously.
 # 
-# This function looks for a currently running process
-# with this task id, and returns either a "still processing"
-# page, an error page, or the completed future.
+# This function looks up the task in the job store, and returns
+# either a "still processing" page, an error page, or the result.
 #
 def get_results_by_task_id(done):
     status_page = None
-    future = None
+    result = None
 
-    if "task_id" not in session:
+    task_id = session.get("task_id")
+    job = jobs.get(task_id) if task_id is not None else None
+    if task_id is None:
         status_page = f"No job started, do not access this page directly."
+    elif job is None:
+        status_page = f"Job with task_id {task_id} not found"
+    elif job['status'] == jobs.RUNNING:
+        logger.debug("Job is still running...")
+        status_page = render_template('report/await_processing.jinja', done=done)
     else:
-        # Find the correct Future instance
-        task_id = session["task_id"]
-        if executor is None:
-            status_page = render_template('report/await_processing.jinja', done=done)
-
-    if status_page is None:
-        if not executor.futures.done(task_id):
-            logger.debug("Job is still running...")
-            status_page = render_template('report/await_processing.jinja', done=done)
-
-    if status_page is None:
-        # we have finished!
-        future = executor.futures.pop(task_id)
+        # we have finished! The job stays in the store so others can reuse it.
         session["task_id"] = None
-        if future is None:
-            status_page = f"Future with task_id {task_id} not found"
+        if job['status'] == jobs.ERROR:
+            status_page = f"Error running job: {job['error']}"
         else:
-            # was there an exception from the future?
-            exception = future.exception()
-            if exception is not None:
-                # The function raised an exception           
-                status_page = f"Error running job: {exception}"
+            result = jobs.load_result(task_id)
+            if result is None:
+                status_page = f"The result of job {task_id} has expired, please run the report again."
+
+    return status_page, result
+
+
+# Long-poll endpoint for the "processing" page. Returns the task's progress
+# as JSON as soon as it changes from version `since`, or after `wait` seconds.
+@reports_blueprint.route("/task_status")
+def task_status():
+    task_id = session.get("task_id")
+    job = jobs.get(task_id) if task_id is not None else None
+    if job is None:
+        return jsonify(state="missing")
+
+    since = request.args.get('since', type=int)
+    wait = min(request.args.get('wait', 0, type=float), TASK_STATUS_MAX_WAIT)
+    run_progress = _local_runs.get(task_id)
+    if since is not None and wait > 0 and job['status'] == jobs.RUNNING:
+        if run_progress is not None:
+            run_progress.wait(since, wait)
+            job = jobs.get(task_id)
+        else:
+            # Running in another worker: watch its progress in the store
+            deadline = time.monotonic() + wait
+            while (job['status'] == jobs.RUNNING and (job['progress'] or {}).get('version', 0) == since
+                   and time.monotonic() < deadline):
+                time.sleep(TASK_STATUS_POLL_INTERVAL)
+                job = jobs.get(task_id)
+
+    if run_progress is not None:
+        snapshot = run_progress.snapshot()
+    else:
+        snapshot = job['progress'] or progress.Progress().snapshot()
+    return jsonify(state=job['status'], **snapshot)
+
+
+# Download a finished report's result, e.g. /reports/slack_orphans/export.csv?task_id=...
+# The file is generated while it is sent (see exports.py).
+@reports_blueprint.route("/<report>/export.<file_format>")
+def export_report(report, file_format):
+    if report not in exports.REPORTS or file_format not in exports.available_formats():
+        return f"No {file_format} download for {report}.", 404
+
+    function_name, columns, rows = exports.REPORTS[report]
+    task_id = request.args.get('task_id')
+    job = jobs.get(task_id) if task_id else None
+    result = None
+    if job is not None and job['report'] == function_name and job['status'] == jobs.DONE:
+        result = jobs.load_result(task_id)
+    if result is None:
+        return "This report result is no longer available, please run the report again.", 404
+
+    mimetype, stream = exports.FORMATS[file_format]
+    filename = f"{report}-{datetime.today().strftime('%Y-%m-%d')}.{file_format}"
+    return Response(stream(columns, rows(result)), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+# Report history, from the snapshots every finished run leaves (see snapshots.py).
+# Runs are compared with others that had the same arguments, given as
+# ?args=<JSON> and by default those of the latest run.
+def _args_label(args):
+    return json.dumps(args, sort_keys=True) if args is not None else None
+
+
+def _requested_snapshot_args(report):
+    if request.args.get('args'):
+        return json.loads(request.args['args'])
+    known = snapshots.arguments(report)
+    return known[0] if known else None
+
+
+@reports_blueprint.route("/<report>/history")
+def report_history(report):
+    if report not in snapshots.METRICS:
+        return f"No history for {report}.", 404
+    try:
+        args = _requested_snapshot_args(report)
+    except ValueError:
+        return "args must be JSON.", 400
+    history = snapshots.history(report, args)
+    metric_names = []
+    for snapshot in history:
+        metric_names.extend(name for name in snapshot['metrics'] if name not in metric_names)
+    return render_template("report/history.jinja", report=report, history=history, metric_names=metric_names,
+                           args=_args_label(args),
+                           all_args=[_args_label(other) for other in snapshots.arguments(report)], datetime=datetime)
+
+
+# Trend data as JSON, oldest first, e.g. for a spreadsheet
+@reports_blueprint.route("/<report>/trend")
+def report_trend(report):
+    if report not in snapshots.METRICS:
+        return f"No history for {report}.", 404
+    try:
+        args = _requested_snapshot_args(report)
+    except ValueError:
+        return "args must be JSON.", 400
+    return jsonify([{'snapshot': snapshot['id'], 'created': datetime.fromtimestamp(snapshot['created']).isoformat(),
+                     **snapshot['metrics']} for snapshot in reversed(snapshots.history(report, args, limit=1000))])
+
+
+# What changed between two snapshots; by default the latest and the one before it
+@reports_blueprint.route("/<report>/diff")
+def report_diff(report):
+    if report not in snapshots.METRICS:
+        return f"No history for {report}.", 404
+    try:
+        args = _requested_snapshot_args(report)
+    except ValueError:
+        return "args must be JSON.", 400
+    latest = snapshots.history(report, args, limit=2)
+    new_id = request.args.get('new', type=int) or (latest[0]['id'] if latest else None)
+    old_id = request.args.get('old', type=int) or (latest[1]['id'] if len(latest) > 1 else None)
+    old_result = snapshots.load(report, old_id) if old_id is not None else None
+    new_result = snapshots.load(report, new_id) if new_id is not None else None
+    if old_result is None or new_result is None:
+        return f"There are not two snapshots of {report} to compare yet.", 404
+    return render_template("report/diff.jinja", report=report, old_id=old_id, new_id=new_id, zip=zip,
+                           args=_args_label(args),
+                           **snapshots.diff(report, old_result, new_result))
+
 
-    return status_page, future
+def start_date_for(delta_days):
+    return (datetime.today() - timedelta(days=delta_days)).strftime('%Y-%m-%d')
 
 
 @reports_blueprint.route("/missing_instructor_checkins")
 def report_missing_instructor_checkins():
     # set reporting start date based on delta_days, defaults to 31 days ago
     try:
-        delta_days = int(request.args.get('delta_days', 31))
+        delta_days = int(request.args.get('delta_days', DEFAULT_DELTA_DAYS))
         logger.info(f"Looking for missing instructor checkins over the past {delta_days} days.")
     except ValueError:
         flash(f"Input value for Missing Instructor Checkins {request.args.get('delta_days')} "
               f"was not an integer.", "error")
         return redirect(url_for('reports.index'))
 
-    start_date = (datetime.today() - timedelta(days=delta_days)).strftime('%Y-%m-%d')
-
-    start_report_task(get_missing_instructor_checkins, start_date)
+    start_report_task(get_missing_instructor_checkins, start_date_for(delta_days),
+                      live=request.args.get('live') == '1', refresh=request.args.get('refresh') == '1')
 
     return redirect(url_for('reports.missing_instructor_checkins_complete',
                             done='reports.missing_instructor_checkins_complete'))
 
 
-def get_missing_instructor_checkins(start_date):
+def _is_past_class(event):
+    # Same selection as the API filter in missing_instructor_checkins_needs, applied locally
+    return ('_S' in event.name or '_P' in event.name) and event.start <= datetime.now(timezone.utc)
+
+
+def missing_instructor_checkins_needs(start_date):
     filter_string = (f"StartDate gt {start_date} AND IsUpcoming eq false AND (substringof('Name', '_S') "
                      f"OR substringof('Name', '_P'))")
-    json_data = wadata.call_api("Events", filter_string=filter_string)
+    return {'events': planner.Need("Events", MISSING_CHECKINS_EVENT_FIELDS, filter_string=filter_string,
+                                   predicate=_is_past_class, start_after=start_date)}
+
 
-    cancel_list = ['cancelled', 'canceled', 'cancellled', 'cancselled', 'canelled', 'cancel']
-    events = [[event['Id'], event['Name'], event['StartDate']] for event in json_data['Events'] if
-              (not any(word in event['Name'].lower() for word in cancel_list))]
+def get_missing_instructor_checkins(start_date, live=False):
+    data = planner.fetch(missing_instructor_checkins_needs(start_date), live=live)
+    return missing_instructor_checkins_from(data, start_date, live=live)
+
+
+def missing_instructor_checkins_from(data, start_date, live=False):
+    """Build the report from the records planned by missing_instructor_checkins_needs."""
+    # Older events than the mirror holds were fetched from the API, and so are their registrations
+    use_mirror = mirror.ENABLED and not live and mirror.covers_events(start_date)
+    events = [event for event in data['events'] if not event.cancelled]
     logger.info(f"Found {len(events)} events to check.")
 
-    if len(events) > 250:
-        return f"Too many events found: ({len(events)}). Please narrow your search."
+    logger.debug("Events: %s", metrics.lazy_json(events))
 
-    logger.debug(f"Events JSON data: {json.dumps(json_data, indent=4)}")
+    # Events whose check-ins have settled keep their earlier verdict (see
+    # verdicts.py); only the rest need their registrations. live rechecks all.
+    known = verdicts.settled(events) if verdicts.ENABLED and not live else {}
+    to_check = [event for event in events if event.id not in known]
+    logger.info(f"Reusing {len(known)} settled verdicts, checking {len(to_check)} events.")
 
     '''
     We need to find events with instructors that are not checked in.
+    Registrations are fetched concurrently and come back in event order.
     '''
+    progress.start_stage(len(to_check), "events checked")
+    if use_mirror:
+        registrations = [records.registrations(event_registrations) for event_registrations in
+                         mirror.registrations([event.id for event in to_check])]
+        progress.advance(len(to_check))
+    else:
+        registrations = wadata.call_api_many("EventRegistrations", [event.id for event in to_check],
+                                             fields=MISSING_CHECKINS_REGISTRATION_FIELDS,
+                                             decode=records.registrations, refresh=live)
+
+    checked = {}
+    # Only verdicts read from the API are kept: the mirror may be part way
+    # through a sync, and an event with no registrations yet may still get some
+    final = {}
+    for event, event_registrations in zip(to_check, registrations):
+        checked[event.id] = [entry.display_name for entry in event_registrations if entry.instructor_missing]
+        if event_registrations:
+            final[event.id] = checked[event.id]
+        logger.debug("Event registrations: %s", metrics.lazy_json(event_registrations))
+    if verdicts.ENABLED and not use_mirror and final:
+        verdicts.save(final)
+
     flawed_events = []
     for event in events:
-        json_data = wadata.call_api("EventRegistrations", event_id=event[0])
-
-        # RegistrationTypeId does not work, not all instructor registrations use the same id number! grr
-        missing_instructors = [entry['DisplayName'] for entry in json_data if 'Instructor' in
-                               entry['RegistrationType']['Name'] and entry['IsCheckedIn'] == False]
+        missing_instructors = known[event.id] if event.id in known else checked[event.id]
         if len(missing_instructors) > 0:
-            # add the name(s) of the instructor to the event
-            event.extend(missing_instructors)
-            # and let's reformat the date while we're at it
-            try:
-                if event[2] is not None:
-                    event[2] = datetime.strptime(event[2], "%Y-%m-%dT%H:%M:%S%z").strftime("%Y-%m-%d %I%p")
-            except Exception as e:
-                logger.warning(f"Unable to format date string {event[2]} {e}")
-                pass
-
-            flawed_events.append(event)
-        logger.debug(f"Event registration JSON data: {json.dumps(json_data, indent=4)}")
+            # the event, the name(s) of the instructor, and the date reformatted while we're at it
+            start = event.start.strftime("%Y-%m-%d %I%p") if event.start is not None else None
+            flawed_events.append([event.id, event.name, start] + missing_instructors)
 
     logger.info(f"Found {len(flawed_events)} flawed events")
 
@@ -173,15 +539,17 @@ def get_missing_instructor_checkins(start_date):
 
 @reports_blueprint.route("/missing_instructor_checkins_complete")
 def missing_instructor_checkins_complete():
-    status_page, future = get_results_by_task_id(done='reports.missing_instructor_checkins_complete')
+    task_id = session.get("task_id")
+    status_page, result = get_results_by_task_id(done='reports.missing_instructor_checkins_complete')
 
     if status_page is not None:
         return status_page
     else:
-        flawed_events, start_date = future.result()
+        flawed_events, start_date = result
 
     return render_template("report/missing_instructor_checkins.jinja", event_info=flawed_events,
-                           start_date=start_date, datetime=datetime)
+                           start_date=start_date, datetime=datetime,
+                           task_id=task_id, export_formats=exports.available_formats(), **_freshness(task_id))
 
 
 @reports_blueprint.route("/slack_orphans", methods=['POST'])
@@ -198,96 +566,167 @@ def report_slack_orphans():
         return redirect(url_for('reports.index'))
 
     if slack_file:
+        # pandas is only imported by the reports that use it, keeping worker startup fast
+        import pandas as pd
+
         try:
-            df = pd.read_csv(slack_file)
+            # Check that the header has the required columns before reading the rest
+            header = pd.read_csv(slack_file, nrows=0).columns
         except Exception as e:
             flash(f"Error reading CSV file: {e}", 'error')
             return redirect(url_for('reports.index'))
 
-        # Check if the dataframe has the required columns
-        required_columns = ['username', 'email', 'fullname', 'status']
-        missing_columns = [column for column in required_columns if column not in df.columns]
+        missing_columns = [column for column in SLACK_COLUMNS if column not in header]
 
         if missing_columns:
             flash(f"The uploaded CSV is missing the following required header columns: "
                   f"{', '.join(missing_columns)}.", 'warning')
             return redirect(url_for('reports.index'))
 
-        start_report_task(get_slack_orphans, df)
+        try:
+            slack_file.stream.seek(0)
+            df = read_slack_export(slack_file)
+        except Exception as e:
+            flash(f"Error reading CSV file: {e}", 'error')
+            return redirect(url_for('reports.index'))
+
+        start_report_task(get_slack_orphans, df, live=request.form.get('live') == '1')
 
     return redirect(url_for('reports.slack_orphans_complete', done='reports.slack_orphans_complete'))
 
 
-def get_slack_orphans(df):
+def read_slack_export(csv_file):
+    """Read a Slack member export in chunks, keeping only the users that could be orphans."""
+    import pandas as pd
+
+    chunks = pd.read_csv(csv_file, usecols=SLACK_COLUMNS, dtype='string', chunksize=SLACK_CSV_CHUNK_ROWS)
+    candidates = [prepare_slack_users(chunk) for chunk in chunks]
+    if not candidates:
+        return prepare_slack_users(pd.DataFrame(columns=SLACK_COLUMNS, dtype='string'))
+    return pd.concat(candidates, ignore_index=True)
+
+
+def prepare_slack_users(df):
+    """Drop deactivated and alumni users and add a normalized email_key column.
+
+    Safe to apply more than once.
+    """
+    if 'email_key' in df.columns:
+        return df
+    # ignore any users that are already deactivated; the columns are read as
+    # the nullable string dtype, so blanks are <NA> and must not compare as NA
+    df = df[df['status'].fillna('') != 'Deactivated']
+    # ignore any (Alumni) users (they are not freeloaders)
+    df = df[~df['fullname'].str.contains('(Alumni)', na=False, regex=False)]
+    df = df[['username', 'fullname', 'email']].copy()
+    df['email_key'] = df['email'].str.strip().str.lower()
+    return df
+
+
+def find_slack_orphans(df, valid_emails):
+    """Return the Slack users (from prepare_slack_users) whose email is not in valid_emails.
+
+    Runs in the "cpu" process pool for big exports, so it must stay picklable
+    and should not log.
+    """
+    # find all rows where the email is *not* in the valid emails set
+    df = df[~df['email_key'].isin(valid_emails)]
+    # return the invalid users and their relevant information
+    # (missing values become None so the result can be stored as JSON)
+    df = df[['username', 'fullname', 'email']].astype(object)
+    return df.where(df.notna(), None).to_dict(orient='records')
+
+
+def _is_current_member(contact):
+    # Same selection as the API filter in slack_orphans_needs, applied locally
+    return (contact.membership_enabled
+            and contact.membership_level_id != 1214629
+            and contact.status in ('Active', 'PendingNew', 'PendingRenewal', 'PendingUpgrade'))
+
+
+def slack_orphans_needs():
     # As presently written, this includes ALL membership levels except for
     # Youth Robotics, one-time payment.
     filter_string = "IsMember eq true AND MembershipLevelId ne 1214629 AND ('Status' eq 'Active' " \
                     "or 'Status' eq 'PendingNew' or 'Status' eq 'PendingRenewal' or 'Status' eq 'PendingUpgrade')"
-    json_data = wadata.call_api("Contacts", filter_string=filter_string)
+    return {'contacts': planner.Need("Contacts", SLACK_ORPHANS_CONTACT_FIELDS, filter_string=filter_string,
+                                     predicate=_is_current_member)}
 
-    valid_emails = [contact['Email'] for contact in json_data['Contacts'] if contact['Email'] is not None]
 
-    logger.debug(f"Valid emails: {len(valid_emails)}")
-    logger.debug(df.head())
+def get_slack_orphans(df, live=False):
+    contacts = planner.fetch(slack_orphans_needs(), live=live)['contacts']
+    valid_emails = {contact.email_key for contact in contacts if contact.email_key is not None}
 
-    # ignore any users that are already deactivated
-    df = df[df['status'] != 'Deactivated']
-    # ignore any (Alumni) users (they are not freeloaders)
-    df = df[~df['fullname'].str.contains('(Alumni)', na=False, regex=False)]
-    # find all rows where the email is *not* in the valid emails list
-    df = df[~df['email'].isin(valid_emails)]
-    logger.debug(f"Filtered df length: {df.shape[0]}")
+    logger.debug(f"Valid emails: {len(valid_emails)}")
 
-    # return the invalid users and their relevant information
-    orphans = df[['username', 'fullname', 'email']].to_dict(orient='records')
+    df = prepare_slack_users(df)
+    logger.debug("%s", df.head())
+    if len(df) >= SLACK_PROCESS_POOL_MIN_ROWS:
+        # Big exports: do the pandas work in another process, so it doesn't
+        # hold this process's GIL while other reports are fetching
+        orphans = get_executor('cpu').submit(find_slack_orphans, df, valid_emails).result()
+    else:
+        orphans = find_slack_orphans(df, valid_emails)
     logger.debug(f"Orphans length: {len(orphans)}")
-    logger.debug(f"{orphans[0]}")
+    if orphans:
+        logger.debug("%s", orphans[0])
 
     return orphans, len(valid_emails)
 
 
 @reports_blueprint.route("/slack_orphans_complete")
 def slack_orphans_complete():
-    status_page, future = get_results_by_task_id(done='reports.slack_orphans_complete')
+    task_id = session.get("task_id")
+    status_page, result = get_results_by_task_id(done='reports.slack_orphans_complete')
 
     if status_page is not None:
         return status_page
     else:
-        orphans, num_membership_emails = future.result()
+        orphans, num_membership_emails = result
 
     return render_template("report/slack_orphans.jinja", orphans=orphans,
                            num_orphans=len(orphans),
-                           num_membership_emails=num_membership_emails)
+                           num_membership_emails=num_membership_emails,
+                           task_id=task_id, export_formats=exports.available_formats(), **_freshness(task_id))
 
 
 @reports_blueprint.route("/makerschool_registrations")
 def report_makerschool_registrations():
     logger.info(f"Looking for makerschool registrations.")
 
-    start_report_task(get_makerschool_registrations)
+    start_report_task(get_makerschool_registrations, live=request.args.get('live') == '1',
+                      refresh=request.args.get('refresh') == '1')
 
     return redirect(url_for('reports.makerschool_registrations_complete',
                             done='reports.makerschool_registrations_complete'))
 
 
-def get_makerschool_registrations():
+def _is_makerschool_event(event):
+    # Same selection as the API filter in makerschool_registrations_needs, applied locally
+    return 'ms' in event.tags
+
+
+def makerschool_registrations_needs(today):
+    return {'events': planner.Need("Events", MAKERSCHOOL_EVENT_FIELDS,
+                                   filter_string=f"Tags in [ms] and StartDate ge {today}",
+                                   predicate=_is_makerschool_event, start_after=today, predicate_fields=['Tags'])}
+
+
+def get_makerschool_registrations(live=False):
     today = datetime.today().strftime('%Y-%m-%d')
+    return makerschool_registrations_from(planner.fetch(makerschool_registrations_needs(today), live=live))
+
+
+def makerschool_registrations_from(data):
+    """Build the report from the records planned by makerschool_registrations_needs."""
+    logger.debug("Events: %s", metrics.lazy_json(data['events']))
 
-    filter_string = (f"Tags in [ms] and StartDate ge {today} ", today)
-    json_data = wadata.call_api("Events", filter_string=filter_string)
-
-    logger.debug(f"Events JSON data: {json.dumps(json_data, indent=4)}")
-
-    cancel_list = ['cancelled', 'canceled', 'cancellled', 'cancselled', 'canelled', 'cancel']
-    events = {event['Id']: {'Name': event['Name'],
-                            'ConfirmedRegistrationsCount': event['ConfirmedRegistrationsCount'],
-                            'RegistrationsLimit': event['RegistrationsLimit'],
-                            'StartDate': datetime.strptime(event['StartDate'],
-                                                           "%Y-%m-%dT%H:%M:%S%z").strftime('%Y-%m-%d'),
-                            'EndDate': datetime.strptime(event['EndDate'],
-                                                         "%Y-%m-%dT%H:%M:%S%z").strftime('%Y-%m-%d')}
-              for event in json_data['Events']
-              if not any(word in event['Name'].lower() for word in cancel_list)}
+    events = {event.id: {'Name': event.name,
+                         'ConfirmedRegistrationsCount': event.confirmed_registrations,
+                         'RegistrationsLimit': event.registrations_limit,
+                         'StartDate': event.start.strftime('%Y-%m-%d'),
+                         'EndDate': event.end.strftime('%Y-%m-%d')}
+              for event in data['events'] if not event.cancelled}
     logger.info(f"Found {len(events)} events to check.")
 
     # find sum of confirmed registrations for all events
@@ -302,12 +741,84 @@ def get_makerschool_registrations():
 
 @reports_blueprint.route("/makerschool_registrations_complete")
 def makerschool_registrations_complete():
-    status_page, future = get_results_by_task_id(done='reports.makerschool_registrations_complete')
+    task_id = session.get("task_id")
+    status_page, result = get_results_by_task_id(done='reports.makerschool_registrations_complete')
 
     if status_page is not None:
         return status_page
     else:
-        events, total_registrations, total_registration_limit = future.result()
+        events, total_registrations, total_registration_limit = result
 
     return render_template("report/makerschool_registrations.jinja", events=events,
-                           total_registrations=total_registrations, total_registration_limit=total_registration_limit)
+                           total_registrations=total_registrations, total_registration_limit=total_registration_limit,
+                           task_id=task_id, export_formats=exports.available_formats(), **_freshness(task_id))
+
+
+# "Run all dashboards": every report that needs no upload, in one task. Their
+# data needs are planned together, so datasets they share (such as Events)
+# are fetched from the API once.
+@reports_blueprint.route("/all_dashboards")
+def report_all_dashboards():
+    try:
+        delta_days = int(request.args.get('delta_days', DEFAULT_DELTA_DAYS))
+    except ValueError:
+        flash(f"Input value for all dashboards {request.args.get('delta_days')} was not an integer.", "error")
+        return redirect(url_for('reports.index'))
+
+    start_report_task(get_all_dashboards, start_date_for(delta_days), live=request.args.get('live') == '1',
+                      refresh=request.args.get('refresh') == '1')
+
+    return redirect(url_for('reports.all_dashboards_complete', done='reports.all_dashboards_complete'))
+
+
+def get_all_dashboards(start_date, live=False):
+    today = datetime.today().strftime('%Y-%m-%d')
+    report_needs = {
+        'missing_instructor_checkins': missing_instructor_checkins_needs(start_date),
+        'makerschool_registrations': makerschool_registrations_needs(today),
+    }
+    data = planner.fetch({(report, name): need for report, needs in report_needs.items()
+                          for name, need in needs.items()}, live=live)
+
+    def data_for(report):
+        return {name: records for (owner, name), records in data.items() if owner == report}
+
+    return {
+        'missing_instructor_checkins': missing_instructor_checkins_from(data_for('missing_instructor_checkins'),
+                                                                        start_date, live=live),
+        'makerschool_registrations': makerschool_registrations_from(data_for('makerschool_registrations')),
+    }
+
+
+# The reports "run all dashboards" runs, by name
+ALL_DASHBOARDS = {
+    'missing_instructor_checkins': get_missing_instructor_checkins,
+    'makerschool_registrations': get_makerschool_registrations,
+}
+
+
+@reports_blueprint.route("/all_dashboards_complete")
+def all_dashboards_complete():
+    task_id = session.get("task_id")
+    status_page, result = get_results_by_task_id(done='reports.all_dashboards_complete')
+
+    if status_page is not None:
+        return status_page
+    else:
+        flawed_events, start_date = result['missing_instructor_checkins']
+        events, total_registrations, total_registration_limit = result['makerschool_registrations']
+
+    return render_template("report/all_dashboards.jinja", event_info=flawed_events, start_date=start_date,
+                           events=events, total_registrations=total_registrations,
+                           total_registration_limit=total_registration_limit, **_freshness(task_id))
+
+
+# Reports the scheduler can pre-warm (see scheduler.py), by name: the report
+# function and its default arguments as (args, kwargs). These must be what the
+# report's route passes by default, so that users' requests find the warm result.
+PREWARM_REPORTS = {
+    'missing_instructor_checkins': (get_missing_instructor_checkins,
+                                    lambda: ((start_date_for(DEFAULT_DELTA_DAYS),), {'live': False})),
+    'makerschool_registrations': (get_makerschool_registrations, lambda: ((), {'live': False})),
+    'all_dashboards': (get_all_dashboards, lambda: ((start_date_for(DEFAULT_DELTA_DAYS),), {'live': False})),
+}
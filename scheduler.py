@@ -0,0 +1,211 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+
+import jobs
+
+logger = logging.getLogger(__name__)
+
+# Pre-warms reports on a schedule, so the ones everyone opens in the morning
+# are already computed (see reports.PREWARM_REPORTS and reports.prewarm_report).
+#
+# The schedule is app.config['PREWARM_SCHEDULE'], {report name: cron
+# expression}, set from WA_REPORTING_PREWARM as "name=expression; ...".
+# Expressions are the usual five cron fields (minute hour day-of-month month
+# day-of-week, in server local time) with *, lists, ranges and steps.
+#
+# Each worker process runs a scheduler thread. Under gunicorn it starts as the
+# worker boots (the post_worker_init hook in gunicorn.conf.py); other servers
+# start it with the worker's first request. It is never started while the app
+# is built, so gunicorn --preload is safe. The workers claim each scheduled
+# run in the job store, so only one of them does it. A scheduler that starts
+# after a scheduled time it missed (say after a deploy) runs that slot at
+# once, if it is no older than PREWARM_MAX_AGE_SECONDS and nobody has run it.
+
+# Longest the scheduler sleeps at once, so clock changes are noticed
+CHECK_INTERVAL = 60
+
+FIELD_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+
+def _parse_field(text, low, high):
+    values = set()
+    for part in text.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = int(step)
+            if step < 1:
+                raise ValueError(f"Bad step in cron field {text!r}")
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(value) for value in part.split("-", 1))
+        else:
+            start = end = int(part)
+            if step != 1:
+                end = high
+        if not low <= start <= end <= high:
+            raise ValueError(f"Cron field {text!r} is out of range {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule:
+    """A five-field cron expression, e.g. "0 6 * * 1-5" for 6am on weekdays."""
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression {expression!r} needs five fields")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            _parse_field(field, low, high) for field, (low, high) in zip(fields, FIELD_RANGES))
+        # cron counts Sunday as 0 or 7; Python's weekday() has Monday = 0
+        self.weekdays = {(day - 1) % 7 for day in weekdays}
+        # As in cron, when both day fields are restricted either one may match
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+
+    def _day_matches(self, when):
+        day_ok = when.day in self.days
+        weekday_ok = when.weekday() in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, when):
+        """Return the first matching minute after when (a naive local datetime)."""
+        candidate = when.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = candidate.year + 5
+        while candidate.year <= limit:
+            if candidate.month not in self.months:
+                month_start = candidate.replace(day=1, hour=0, minute=0)
+                candidate = (month_start + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(candidate):
+                candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+            elif candidate.hour not in self.hours:
+                candidate = candidate.replace(minute=0) + timedelta(hours=1)
+            elif candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+            else:
+                return candidate
+        raise ValueError(f"Cron expression {self.expression!r} never matches")
+
+    def last_between(self, start, end):
+        """Return the last matching minute after start and no later than end, or None."""
+        last = None
+        candidate = self.next_after(start)
+        while candidate <= end:
+            last = candidate
+            candidate = self.next_after(candidate)
+        return last
+
+
+def parse_schedule(text):
+    """Parse WA_REPORTING_PREWARM ("name=expression; ...") into {name: expression}."""
+    if not text or text.strip().lower() in ("off", "false", "no", "0"):
+        return {}
+    schedule = {}
+    for entry in text.split(";"):
+        if entry.strip():
+            name, expression = entry.split("=", 1)
+            schedule[name.strip()] = expression.strip()
+    return schedule
+
+
+_started_pid = None
+_start_lock = threading.Lock()
+
+
+def init_app(app):
+    """Start the scheduler with the first request each worker process handles, if nothing started it sooner."""
+
+    @app.before_request
+    def start_scheduler():
+        if _started_pid != os.getpid():
+            start(app)
+
+
+def start(app):
+    """Start this process's scheduler thread for app's PREWARM_SCHEDULE, if not already running."""
+    global _started_pid
+    # Imported here because reports imports most of the app
+    import reports
+
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+        _started_pid = os.getpid()
+        entries = []
+        for name, expression in app.config.get('PREWARM_SCHEDULE', {}).items():
+            if name not in reports.PREWARM_REPORTS:
+                logger.warning(f"Cannot pre-warm unknown report {name}.")
+                continue
+            try:
+                entries.append([name, CronSchedule(expression)])
+            except ValueError as e:
+                logger.warning(f"Not pre-warming {name}: {e}")
+        if not entries:
+            return
+        thread = threading.Thread(target=_run, args=(app, entries), name="prewarm-scheduler", daemon=True)
+        thread.start()
+        logger.info(f"Pre-warm scheduler started for {', '.join(name for name, _ in entries)}.")
+
+
+def _prewarm(app, name, slot):
+    import reports
+
+    if not jobs.claim_slot(name, slot.timestamp()):
+        logger.debug(f"Pre-warm of {name} at {slot} was claimed by another worker.")
+        return
+    try:
+        with app.app_context():
+            reports.prewarm_report(name)
+    except Exception:
+        logger.exception(f"Pre-warming {name} failed.")
+
+
+def _run(app, entries):
+    import reports
+
+    now = datetime.now()
+    # Catch up on the latest slot missed while no scheduler was running
+    max_age = timedelta(seconds=app.config.get('PREWARM_MAX_AGE_SECONDS', 0))
+    for name, schedule in entries:
+        missed = schedule.last_between(now - max_age, now)
+        if missed is not None and not reports.is_prewarmed(name, missed.timestamp()):
+            logger.info(f"Catching up on the pre-warm of {name} due at {missed}.")
+            _prewarm(app, name, missed)
+
+    # name -> next scheduled run
+    due = {name: schedule.next_after(now) for name, schedule in entries}
+    schedules = dict(entries)
+    while True:
+        name = min(due, key=due.get)
+        delay = (due[name] - datetime.now()).total_seconds()
+        if delay > 0:
+            time.sleep(min(delay, CHECK_INTERVAL))
+            continue
+
+        slot = due[name]
+        due[name] = schedules[name].next_after(max(slot, datetime.now()))
+        _prewarm(app, name, slot)
+
+
+@click.command("prewarm")
+@click.argument("names", nargs=-1)
+def prewarm_command(names):
+    """Pre-warm reports now (NAMES, or every report in the schedule)."""
+    import reports
+
+    for name in names or current_app.config.get('PREWARM_SCHEDULE', {}):
+        if name not in reports.PREWARM_REPORTS:
+            raise click.BadParameter(f"Unknown report {name}, expected one of {', '.join(reports.PREWARM_REPORTS)}")
+        click.echo(f"Pre-warming {name}...")
+        reports.prewarm_report(name)
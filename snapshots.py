@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import zlib
+import hashlib
+import logging
+import threading
+
+import exports
+import localstore
+
+logger = logging.getLogger(__name__)
+
+# Every finished report result is kept as a snapshot in SQLite, so results
+# can be compared over time without calling the API again: what changed
+# between two runs (diff), and how a report's headline numbers move (trend).
+#
+# Results are stored compressed, once per distinct content: a report that
+# returns the same data every morning adds a row of metrics, not another
+# copy of the data. Snapshots older than WA_REPORTING_SNAPSHOT_KEEP_DAYS are
+# dropped.
+#
+# Each snapshot records the arguments of the run that made it (e.g.
+# {"delta_days": 30, "live": false}), and history, diff and trend only
+# compare runs with the same arguments.
+SNAPSHOT_KEEP_DAYS = int(os.environ.get("WA_REPORTING_SNAPSHOT_KEEP_DAYS", 365))
+
+_conn = None
+_conn_lock = threading.RLock()
+
+
+def _connect():
+    global _conn
+    with _conn_lock:
+        if _conn is None:
+            _conn = localstore.connect("snapshots.sqlite3")
+            _conn.executescript("""
+                CREATE TABLE IF NOT EXISTS snapshots (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, report TEXT, created REAL,
+                    digest TEXT, metrics TEXT, args TEXT NOT NULL);
+                CREATE INDEX IF NOT EXISTS snapshots_report ON snapshots (report, created);
+                CREATE INDEX IF NOT EXISTS snapshots_report_args ON snapshots (report, args, id);
+                CREATE TABLE IF NOT EXISTS snapshot_data (digest TEXT PRIMARY KEY, data BLOB);
+            """)
+        return _conn
+
+
+def _missing_instructor_checkins_metrics(result):
+    flawed_events, start_date = result
+    return {'since': start_date, 'flawed_classes': len(flawed_events),
+            'missing_instructors': sum(len(event) - 3 for event in flawed_events)}
+
+
+def _slack_orphans_metrics(result):
+    orphans, num_membership_emails = result
+    return {'orphans': len(orphans), 'member_emails': num_membership_emails}
+
+
+def _makerschool_registrations_metrics(result):
+    events, total_registrations, total_registration_limit = result
+    return {'events': len(events), 'registrations': total_registrations,
+            'registration_limit': total_registration_limit,
+            'fill_rate': round(total_registrations / total_registration_limit, 3) if total_registration_limit else None}
+
+
+# Report name -> the numbers tracked over time for its results
+METRICS = {
+    'missing_instructor_checkins': _missing_instructor_checkins_metrics,
+    'slack_orphans': _slack_orphans_metrics,
+    'makerschool_registrations': _makerschool_registrations_metrics,
+}
+
+
+def _args_label(args):
+    return json.dumps(args, sort_keys=True, default=str)
+
+
+def record(report, result, args=None):
+    """Store a finished result of report (a name in METRICS) as a new snapshot. Returns its id.
+
+    args are the run's arguments, {name: value}.
+    """
+    # Round-trip through JSON first, so snapshots look like results read back from the job store
+    data = json.dumps(result, sort_keys=True)
+    result = json.loads(data)
+    digest = hashlib.sha256(data.encode("utf-8")).hexdigest()
+    now = time.time()
+    with _conn_lock:
+        conn = _connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT OR IGNORE INTO snapshot_data (digest, data) VALUES (?, ?)",
+                         (digest, zlib.compress(data.encode("utf-8"), 9)))
+            snapshot_id = conn.execute(
+                "INSERT INTO snapshots (report, created, digest, metrics, args) VALUES (?, ?, ?, ?, ?)",
+                (report, now, digest, json.dumps(METRICS[report](result)), _args_label(args or {})),
+            ).lastrowid
+            # Prune old snapshots, and data no snapshot uses any more
+            conn.execute("DELETE FROM snapshots WHERE created < ?", (now - SNAPSHOT_KEEP_DAYS * 86400,))
+            conn.execute("DELETE FROM snapshot_data WHERE digest NOT IN (SELECT digest FROM snapshots)")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    logger.debug(f"Recorded snapshot {snapshot_id} of {report}.")
+    return snapshot_id
+
+
+def arguments(report):
+    """The distinct arguments report has snapshots for, most recently run first."""
+    with _conn_lock:
+        rows = _connect().execute(
+            "SELECT args FROM snapshots WHERE report = ? GROUP BY args ORDER BY MAX(id) DESC", (report,),
+        ).fetchall()
+    return [json.loads(args) for args, in rows]
+
+
+def history(report, args=None, limit=100):
+    """The report's latest snapshots with the same arguments, newest first: [{id, created, metrics, changed}].
+
+    args defaults to the arguments of the report's latest snapshot. changed
+    is False when a snapshot has the same data as the one before it.
+    """
+    with _conn_lock:
+        conn = _connect()
+        if args is None:
+            latest = conn.execute("SELECT args FROM snapshots WHERE report = ? ORDER BY id DESC LIMIT 1",
+                                  (report,)).fetchone()
+            label = latest[0] if latest else None
+        else:
+            label = _args_label(args)
+        rows = conn.execute(
+            "SELECT id, created, digest, metrics FROM snapshots WHERE report = ? AND args = ? "
+            "ORDER BY id DESC LIMIT ?",
+            (report, label, limit + 1),
+        ).fetchall()
+    snapshots = []
+    for (snapshot_id, created, digest, metrics), older in zip(rows, rows[1:] + [None]):
+        snapshots.append({'id': snapshot_id, 'created': created, 'metrics': json.loads(metrics),
+                          'changed': older is None or older[2] != digest})
+    return snapshots[:limit]
+
+
+def load(report, snapshot_id):
+    """Return a snapshot's result, or None if there is no such snapshot of report."""
+    with _conn_lock:
+        row = _connect().execute(
+            "SELECT snapshot_data.data FROM snapshots JOIN snapshot_data ON snapshot_data.digest = snapshots.digest "
+            "WHERE snapshots.id = ? AND snapshots.report = ?", (snapshot_id, report),
+        ).fetchone()
+    return json.loads(zlib.decompress(row[0])) if row else None
+
+
+def diff(report, old_result, new_result):
+    """Compare two results of report row by row, using its download rows (see exports.REPORTS).
+
+    Rows are matched on their first column (the event id or Slack username).
+    Returns {columns, added, removed, changed}, where changed holds
+    (old row, new row) pairs.
+    """
+    _, columns, rows = exports.REPORTS[report]
+
+    def by_id(result):
+        return {(row[0] if row[0] is not None else tuple(row)): row for row in rows(result)}
+
+    old_rows, new_rows = by_id(old_result), by_id(new_result)
+    return {
+        'columns': [name for name, _ in columns],
+        'added': [row for row_id, row in new_rows.items() if row_id not in old_rows],
+        'removed': [row for row_id, row in old_rows.items() if row_id not in new_rows],
+        'changed': [(old_rows[row_id], row) for row_id, row in new_rows.items()
+                    if row_id in old_rows and list(old_rows[row_id]) != list(row)],
+    }
@@ -15,7 +15,7 @@ def wa_context():
     - Verifies required env vars
     - Ensures project root is importable
     - Creates Flask app + pushes app and request contexts
-    - Refreshes API token into Flask session
+    - Fetches the shared API token
     """
     # Load env
     load_dotenv()
@@ -47,7 +47,7 @@ def wa_context():
     req_ctx = app.test_request_context()
     req_ctx.push()
 
-    # Populate API token into session
+    # Fetch the shared API token
     from auth import refresh_token  # noqa: WPS433 (import after path setup is intentional)
 
     err = refresh_token()
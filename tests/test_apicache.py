@@ -0,0 +1,75 @@
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+# These tests need no credentials or API access
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import apicache  # noqa: E402
+import localstore  # noqa: E402
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def cache(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(localstore, "DATA_DIR", str(tmp_path))
+    if request.param == "memory":
+        return apicache.MemoryCache(max_bytes=100)
+    return apicache.SQLiteCache(max_bytes=100)
+
+
+def test_make_key():
+    # Field order doesn't matter, everything else does
+    assert (apicache.make_key("Contacts", fields=["Email", "Id"])
+            == apicache.make_key("Contacts", fields=["Id", "Email"]))
+    assert apicache.make_key("Contacts", "a") != apicache.make_key("Contacts", "b")
+    assert apicache.make_key("Events", event_id=1) != apicache.make_key("EventRegistrations", event_id=1)
+
+
+def test_get_put_and_expiry(cache):
+    cache.put("a", "Events", b"x" * 10, ttl=60)
+    cache.put("b", "Events", b"y" * 10, ttl=-1)
+    assert cache.get("a") == b"x" * 10
+    assert cache.get("b") is None
+    assert cache.get("missing") is None
+
+
+def test_evicts_least_recently_used(cache):
+    for key in "abc":
+        cache.put(key, "Events", key.encode() * 40, ttl=60)
+        # SQLiteCache orders by last use time
+        time.sleep(0.01)
+    # a and b don't both fit with c; a was used longest ago
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+    time.sleep(0.01)
+    cache.put("d", "Events", b"d" * 40, ttl=60)
+    # b was just read, so c goes instead
+    assert cache.get("b") is not None
+    assert cache.get("c") is None
+    # an entry bigger than the whole cache is not stored
+    cache.put("e", "Events", b"e" * 101, ttl=60)
+    assert cache.get("e") is None
+
+
+def test_invalidate(cache):
+    cache.put("a", "Events", b"a", ttl=60)
+    cache.put("b", "Contacts", b"b", ttl=60)
+    cache.invalidate("Events")
+    assert cache.get("a") is None
+    assert cache.get("b") == b"b"
+    cache.invalidate()
+    assert cache.get("b") is None
+
+
+def test_refreshing_misses_but_stores(monkeypatch):
+    monkeypatch.setattr(apicache, "_cache", apicache.MemoryCache())
+    key = apicache.make_key("Events")
+    token = apicache.refreshing.set(True)
+    try:
+        apicache.put("Events", key, {"Events": [1]})
+        assert apicache.get("Events", key) is None
+    finally:
+        apicache.refreshing.reset(token)
+    assert apicache.get("Events", key) == {"Events": [1]}
@@ -0,0 +1,119 @@
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+# These tests need no credentials or API access
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import jobs  # noqa: E402
+import localstore  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(localstore, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(jobs, "_conn", None)
+
+
+def age(task_id, seconds):
+    """Make a job look as if it was last touched, and finished if it has, seconds ago."""
+    then = time.time() - seconds
+    jobs._connect().execute("UPDATE jobs SET updated = ?, finished = CASE WHEN finished IS NULL THEN NULL ELSE ? END "
+                            "WHERE task_id = ?", (then, then, task_id))
+
+
+def test_claim_shares_running_and_recent_jobs():
+    task_id, created = jobs.claim("key", "report", reuse_seconds=60)
+    assert created
+    assert jobs.claim("key", "report", reuse_seconds=60) == (task_id, False)
+    assert jobs.claim("other", "report", reuse_seconds=60)[1]
+
+    jobs.finish(task_id, result={"rows": [1, 2]})
+    assert jobs.claim("key", "report", reuse_seconds=60) == (task_id, False)
+    assert jobs.get(task_id)["status"] == jobs.DONE
+    assert jobs.load_result(task_id) == {"rows": [1, 2]}
+    # too old to reuse
+    age(task_id, 120)
+    assert jobs.claim("key", "report", reuse_seconds=60)[0] != task_id
+
+
+def test_failed_and_dead_jobs_are_not_shared():
+    task_id, _ = jobs.claim("key", "report", reuse_seconds=60)
+    jobs.finish(task_id, error="boom")
+    assert jobs.get(task_id)["error"] == "boom"
+    assert jobs.claim("key", "report", reuse_seconds=60)[0] != task_id
+
+    task_id, _ = jobs.claim("dead", "report", reuse_seconds=60)
+    age(task_id, jobs.STALE_SECONDS + 1)
+    assert jobs.get(task_id)["status"] == jobs.ERROR
+    assert jobs.claim("dead", "report", reuse_seconds=60)[0] != task_id
+
+
+def test_heartbeat_keeps_a_job_alive(monkeypatch):
+    monkeypatch.setattr(jobs, "HEARTBEAT_SECONDS", 0.05)
+    task_id, _ = jobs.claim("key", "report", reuse_seconds=60)
+    with jobs.Heartbeat(task_id):
+        age(task_id, jobs.STALE_SECONDS + 1)
+        time.sleep(0.2)
+        assert jobs.get(task_id)["status"] == jobs.RUNNING
+
+
+def test_oversized_results_are_refused():
+    task_id, _ = jobs.claim("key", "report", reuse_seconds=60)
+    jobs.finish(task_id, result="x" * 10_000, max_result_bytes=10)
+    assert jobs.get(task_id)["status"] == jobs.ERROR
+    assert jobs.load_result(task_id) is None
+
+
+def test_evict_expires_old_results_and_keeps_the_store_bounded():
+    old, _ = jobs.claim("old", "report", reuse_seconds=0)
+    jobs.finish(old, result="old")
+    age(old, 100)
+    kept = []
+    for key in "abc":
+        task_id, _ = jobs.claim(key, "report", reuse_seconds=0)
+        jobs.finish(task_id, result=key * 1000)
+        kept.append(task_id)
+        time.sleep(0.01)
+    size = jobs._connect().execute("SELECT result_size FROM jobs WHERE task_id = ?", (kept[0],)).fetchone()[0]
+
+    jobs.evict(ttl_seconds=50, max_total_bytes=2 * size)
+    assert jobs.get(old) is None
+    # the oldest result made way for the newer ones
+    assert [jobs.get(task_id) is not None for task_id in kept] == [False, True, True]
+
+
+def test_warm_results():
+    task_id, _ = jobs.claim("key", "report", reuse_seconds=0)
+    jobs.set_warm("key", task_id, "report")
+    assert jobs.find_warm("key", 60) is None  # not finished yet
+    jobs.finish(task_id, result="warm")
+    assert jobs.find_warm("key", 60) == task_id
+
+    # warm results survive expiry and size eviction until they are too old to serve
+    jobs.evict(ttl_seconds=0, max_total_bytes=0, warm_max_age_seconds=60)
+    assert jobs.get(task_id) is not None
+    age(task_id, 120)
+    assert jobs.find_warm("key", 60) is None
+    jobs.evict(ttl_seconds=0, max_total_bytes=0, warm_max_age_seconds=60)
+    assert jobs.get(task_id) is None
+
+
+def test_a_new_warm_key_replaces_the_reports_old_one():
+    first, _ = jobs.claim("monday", "report", reuse_seconds=0)
+    jobs.set_warm("monday", first, "report")
+    jobs.finish(first, result=1)
+    second, _ = jobs.claim("tuesday", "report", reuse_seconds=0)
+    jobs.set_warm("tuesday", second, "report")
+    jobs.finish(second, result=2)
+    assert jobs.find_warm("monday", 60) is None
+    assert jobs.find_warm("tuesday", 60) == second
+
+
+def test_claim_slot_once():
+    assert jobs.claim_slot("report", 100.0)
+    assert not jobs.claim_slot("report", 100.0)
+    assert not jobs.claim_slot("report", 50.0)
+    assert jobs.claim_slot("report", 200.0)
@@ -0,0 +1,83 @@
+import sys
+import time
+from email.utils import formatdate
+from pathlib import Path
+
+import pytest
+
+# These tests need no credentials or API access
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import ratelimit  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, status_code, retry_after=None):
+        self.status_code = status_code
+        self.headers = {"Retry-After": retry_after} if retry_after is not None else {}
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    # A fast, per-process bucket, and no real sleeping between retries
+    bucket = ratelimit.TokenBucket(rate=1000, burst=1000, min_rate=1, shared=False)
+    monkeypatch.setattr(ratelimit, "_bucket", bucket)
+    monkeypatch.setattr(ratelimit, "backoff_delay", lambda attempt, retry_after=None: 0)
+    return bucket
+
+
+def test_retry_after_seconds():
+    assert ratelimit.retry_after_seconds(FakeResponse(429, "3")) == 3.0
+    assert ratelimit.retry_after_seconds(FakeResponse(429, "-5")) == 0.0
+    assert 8 <= ratelimit.retry_after_seconds(FakeResponse(429, formatdate(time.time() + 10, usegmt=True))) <= 10
+    assert ratelimit.retry_after_seconds(FakeResponse(429)) is None
+    assert ratelimit.retry_after_seconds(FakeResponse(429, "soon")) is None
+
+
+def test_backoff_delay():
+    # Retry-After wins, capped at BACKOFF_MAX, plus up to BACKOFF_BASE of jitter
+    assert 7 <= ratelimit.backoff_delay(0, retry_after=7) <= 7 + ratelimit.BACKOFF_BASE
+    assert ratelimit.backoff_delay(0, retry_after=10_000) <= ratelimit.BACKOFF_MAX + ratelimit.BACKOFF_BASE
+    for attempt in range(10):
+        delay = min(ratelimit.BACKOFF_MAX, ratelimit.BACKOFF_BASE * 2 ** attempt)
+        assert delay / 2 <= ratelimit.backoff_delay(attempt) <= delay
+
+
+def test_send_retries_throttled_calls(bucket):
+    responses = iter([FakeResponse(429, "0"), FakeResponse(429, "0"), FakeResponse(200)])
+    assert ratelimit.send(lambda: next(responses)).status_code == 200
+    # Each 429 halved the rate, and the success won a little back
+    assert bucket.min_rate < bucket._state["rate"] < bucket.max_rate / 2
+
+
+def test_send_gives_up_after_max_retries(bucket, monkeypatch):
+    monkeypatch.setattr(ratelimit, "MAX_RETRIES", 3)
+    calls = []
+
+    def request():
+        calls.append(1)
+        return FakeResponse(429, "0")
+
+    assert ratelimit.send(request).status_code == 429
+    assert len(calls) == 4
+
+
+def test_bucket_waits_for_tokens():
+    bucket = ratelimit.TokenBucket(rate=10, burst=2, shared=False)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert 0 < bucket.reserve() <= 0.1
+    # A 429 holds everyone off for the given delay
+    bucket.throttled(5)
+    assert 4.9 < bucket.reserve() <= 5
+
+
+def test_shared_bucket_is_shared(tmp_path, monkeypatch):
+    import localstore
+
+    monkeypatch.setattr(localstore, "DATA_DIR", str(tmp_path))
+    # Two buckets on the same store stand in for two worker processes
+    first = ratelimit.TokenBucket(rate=0.01, burst=1, shared=True)
+    second = ratelimit.TokenBucket(rate=0.01, burst=1, shared=True)
+    assert first.reserve() == 0
+    assert second.reserve() > 0
@@ -0,0 +1,42 @@
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+# These tests need no credentials, so they don't use the wa_context fixture
+# that normally puts the project root on the path
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from scheduler import CronSchedule, parse_schedule  # noqa: E402
+
+
+def test_cron_next_after():
+    # daily at 6am
+    assert CronSchedule("0 6 * * *").next_after(datetime(2026, 3, 1, 7, 0)) == datetime(2026, 3, 2, 6, 0)
+    # every 15 minutes in working hours on weekdays; 2026-10-17 is a Saturday
+    assert (CronSchedule("*/15 9-17 * * 1-5").next_after(datetime(2026, 10, 17, 12, 0))
+            == datetime(2026, 10, 19, 9, 0))
+    # day of month OR day of week when both are given, as in cron
+    assert CronSchedule("30 5 1 * 0").next_after(datetime(2026, 10, 18, 6, 0)) == datetime(2026, 10, 25, 5, 30)
+    assert CronSchedule("0 0 29 2 *").next_after(datetime(2026, 3, 1)) == datetime(2028, 2, 29, 0, 0)
+
+
+def test_cron_rejects_bad_expressions():
+    for expression in ["0 6 * *", "60 * * * *", "*/0 * * * *", "0 0 31 2 *"]:
+        with pytest.raises(ValueError):
+            CronSchedule(expression).next_after(datetime(2026, 1, 1))
+
+
+def test_parse_schedule():
+    assert parse_schedule("a=0 6 * * *; b=*/5 * * * *") == {"a": "0 6 * * *", "b": "*/5 * * * *"}
+    assert parse_schedule("off") == {}
+
+
+def test_cron_last_between():
+    daily = CronSchedule("0 6 * * *")
+    # a worker starting at 7am has missed today's 6am run
+    assert daily.last_between(datetime(2026, 3, 1, 7, 0) - timedelta(days=1), datetime(2026, 3, 1, 7, 0)) \
+        == datetime(2026, 3, 1, 6, 0)
+    assert daily.last_between(datetime(2026, 3, 1, 6, 30), datetime(2026, 3, 1, 7, 0)) is None
+    assert daily.last_between(datetime(2026, 3, 1, 5, 0), datetime(2026, 3, 1, 6, 0)) == datetime(2026, 3, 1, 6, 0)
@@ -0,0 +1,32 @@
+import os
+import sys
+import json
+import subprocess
+from pathlib import Path
+
+# Importing the app should stay cheap: gunicorn workers import it on every
+# boot. The budget is generous for slow machines; the heavy modules must not
+# be imported at all. Needs no credentials or API access.
+IMPORT_BUDGET_SECONDS = float(os.environ.get("WA_REPORTING_IMPORT_BUDGET", 1.5))
+HEAVY_MODULES = ["pandas", "numpy", "pyarrow", "httpx"]
+
+CHECK = """
+import sys, time, json
+start = time.perf_counter()
+import wareporting
+print(json.dumps({"seconds": time.perf_counter() - start,
+                  "heavy": [name for name in HEAVY if name in sys.modules]}))
+"""
+
+
+def test_import_time_budget():
+    project_root = Path(__file__).resolve().parents[1]
+    env = {name: value for name, value in os.environ.items() if not name.startswith("WA_")}
+    env["WA_REPORTING_FLASK_SECRET_KEY"] = "test"
+    result = subprocess.run([sys.executable, "-c", f"HEAVY = {HEAVY_MODULES!r}" + CHECK], cwd=project_root,
+                            env=env, capture_output=True, text=True, check=True)
+    measured = json.loads(result.stdout.splitlines()[-1])
+
+    print(f"Importing wareporting took {measured['seconds']:.3f}s")
+    assert measured["heavy"] == []
+    assert measured["seconds"] < IMPORT_BUDGET_SECONDS
@@ -0,0 +1,103 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# These tests run against the mock Wild Apricot server in benchmarks/, so they
+# need no credentials or API access
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import auth  # noqa: E402
+import localstore  # noqa: E402
+import ratelimit  # noqa: E402
+import wadata  # noqa: E402
+from benchmarks import mockwa  # noqa: E402
+
+MEMBERS = "IsMember eq true"
+
+
+@pytest.fixture(scope="module")
+def server():
+    server = mockwa.MockWildApricot(mockwa.make_dataset(2000)).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def api(server, tmp_path, monkeypatch):
+    """Point wadata at the mock server, with a fast rate limit and no response cache."""
+    monkeypatch.setattr(localstore, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(auth, "WA_API_PREFIX", server.api_prefix)
+    monkeypatch.setattr(auth, "WA_API_TOKEN_URL", server.token_url)
+    monkeypatch.setattr(auth, "_api_token", None)
+    monkeypatch.setattr(auth, "_api_session", None)
+    monkeypatch.setenv("WA_REPORTING_API_KEY", "test")
+    monkeypatch.setenv("OAUTHLIB_INSECURE_TRANSPORT", "1")
+    monkeypatch.setattr(ratelimit, "_bucket", ratelimit.TokenBucket(rate=1000, burst=100, shared=False))
+    monkeypatch.setattr(wadata.apicache, "BACKEND", "off")
+    monkeypatch.setattr(wadata.apicache, "_cache", None)
+    server.reset_counts()
+    return server
+
+
+def ids(records):
+    return [record['Id'] for record in records]
+
+
+def test_parallel_pages_match_sequential(api):
+    sequential = wadata.call_api("Contacts", filter_string=MEMBERS)['Contacts']
+    assert len(sequential) > 5 * wadata.PAGE_SIZE
+    api.reset_counts()
+    parallel = wadata.call_api("Contacts", filter_string=MEMBERS, parallel=True)['Contacts']
+    assert ids(parallel) == ids(sequential)
+    # every page once, plus the $count probe
+    assert api.requests['Contacts'] == len(sequential) // wadata.PAGE_SIZE + 2
+
+
+def test_parallel_pages_drop_records_seen_twice(api, monkeypatch):
+    expected = ids(wadata.call_api("Contacts", filter_string=MEMBERS)['Contacts'])
+    filtered = api._filtered
+    calls = []
+
+    def shifting(category, filter_string):
+        # After the first page, a new contact sorts first and pushes every
+        # record one place on, so the next page repeats the last one
+        calls.append(1)
+        records = filtered(category, filter_string)
+        return records if len(calls) == 1 else [dict(records[0], Id=-1)] + records
+
+    monkeypatch.setattr(api, "_filtered", shifting)
+    records = wadata.call_api("Contacts", filter_string=MEMBERS, parallel=True)['Contacts']
+    assert len(ids(records)) == len(set(ids(records)))
+    assert set(expected) <= set(ids(records))
+
+
+def test_parallel_pages_stay_ahead_of_the_caller_by_a_bounded_window(api):
+    pages = wadata.iter_api("Contacts", filter_string=MEMBERS, parallel=True, pages=True)
+    next(pages)
+    next(pages)
+    # the first page, the $count probe, and at most MAX_WORKERS pages fetched ahead
+    assert api.requests['Contacts'] <= 2 + wadata.MAX_WORKERS + 1
+    total = 2 + sum(1 for _ in pages)
+    assert total > 2 + wadata.MAX_WORKERS + 1
+
+
+def test_drop_seen():
+    seen = set()
+    assert wadata._drop_seen({'Contacts': [{'Id': 1}, {'Id': 2}]}, seen) == {'Contacts': [{'Id': 1}, {'Id': 2}]}
+    assert wadata._drop_seen({'Contacts': [{'Id': 2}, {'Id': 3}, {'Name': 'no id'}]}, seen) \
+        == {'Contacts': [{'Id': 3}, {'Name': 'no id'}]}
+    assert wadata._drop_seen([{'Id': 3}, {'Id': 4}], seen) == [{'Id': 4}]
+    # responses that aren't collections pass through
+    assert wadata._drop_seen({'Count': 3}, seen) == {'Count': 3}
+
+
+def test_total_count():
+    assert wadata._total_count({'Contacts': [], 'Count': 250}, lambda: pytest.fail("no probe needed")) == 250
+    assert wadata._total_count({'Contacts': []}, lambda: {'Count': 250}) == 250
+    assert wadata._total_count({'Contacts': []}, lambda: {'Contacts': []}) is None
+
+    def failing_probe():
+        raise Exception("API call failed with 400")
+
+    assert wadata._total_count({'Contacts': []}, failing_probe) is None
@@ -0,0 +1,73 @@
+import os
+import json
+import time
+import logging
+import threading
+
+import localstore
+
+logger = logging.getLogger(__name__)
+
+# Per-event verdicts for the missing instructor checkins report: which
+# instructors were not checked in, and when that was worked out. Check-ins
+# are sometimes fixed up in the days after a class, but not weeks later, so
+# a verdict computed at least WA_CHECKIN_SETTLE_DAYS after the event started
+# is final. Later runs reuse final verdicts and fetch registrations only for
+# new events and those that may still change, so a long look-back window
+# costs about as much as a short one.
+# Verdicts are only saved from registrations read from the API, and not for
+# events with no registrations yet.
+ENABLED = os.environ.get("WA_CHECKIN_INDEX", "true").lower() in ("1", "true", "yes", "on")
+SETTLE_SECONDS = float(os.environ.get("WA_CHECKIN_SETTLE_DAYS", 14)) * 86400
+
+_conn = None
+_conn_lock = threading.RLock()
+
+
+def _connect():
+    global _conn
+    with _conn_lock:
+        if _conn is None:
+            _conn = localstore.connect("verdicts.sqlite3")
+            _conn.execute(
+                "CREATE TABLE IF NOT EXISTS checkin_verdicts (event_id INTEGER PRIMARY KEY, "
+                "missing_instructors TEXT, computed REAL)"
+            )
+        return _conn
+
+
+def settled(events):
+    """Final verdicts for those of events (records.Event) that have one: {event id: [missing instructors]}.
+
+    A verdict is final if it was computed SETTLE_SECONDS or more after the
+    event's current start, so a rescheduled event is checked again.
+    """
+    starts = {event.id: event.start.timestamp() for event in events if event.start is not None}
+    event_ids = list(starts)
+    verdicts = {}
+    with _conn_lock:
+        conn = _connect()
+        # Stay well under SQLite's limit on query parameters
+        for i in range(0, len(event_ids), 500):
+            chunk = event_ids[i:i + 500]
+            rows = conn.execute(f"SELECT event_id, missing_instructors, computed FROM checkin_verdicts "
+                                f"WHERE event_id IN ({', '.join('?' * len(chunk))})", chunk)
+            for event_id, missing_instructors, computed in rows:
+                if computed >= starts[event_id] + SETTLE_SECONDS:
+                    verdicts[event_id] = json.loads(missing_instructors)
+    return verdicts
+
+
+def save(verdicts):
+    """Record freshly computed verdicts, {event id: [missing instructors]}."""
+    now = time.time()
+    with _conn_lock:
+        conn = _connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT OR REPLACE INTO checkin_verdicts VALUES (?, ?, ?)",
+                             [(event_id, json.dumps(missing), now) for event_id, missing in verdicts.items()])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
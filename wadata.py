@@ -1,7 +1,14 @@
 import auth
+import apicache
+import metrics
+import progress
+import ratelimit
 import logging
-from time import sleep
-import json
+import os
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 logger = logging.getLogger(__name__)
 
@@ -9,6 +16,26 @@ logger = logging.getLogger(__name__)
 # Maximum size is 100.
 PAGE_SIZE = 100
 
+# Upper bound on concurrent requests when fanning out over many events.
+# Request pacing is handled by the shared limiter in ratelimit.py; this just
+# caps how many threads wait on it at once.
+MAX_WORKERS = int(os.environ.get("WA_API_MAX_WORKERS", 4))
+
+# Run fan-outs on the asyncio client in wadata_async.py instead of threads.
+USE_ASYNC = os.environ.get("WA_API_ASYNC", "false").lower() in ("1", "true", "yes", "on")
+
+# Categories whose $select the API honours, and the $select names of their
+# top-level record keys. For Contacts, $select limits the custom FieldValues
+# returned; the core properties (Id, Status, MembershipLevel...) always come back.
+SELECT_FIELD_NAMES = {
+    "Contacts": {
+        "Email": "e-Mail",
+        "FirstName": "First name",
+        "LastName": "Last name",
+        "Organization": "Organization",
+    },
+}
+
 
 def call_api(
     category,
@@ -16,12 +43,163 @@ def call_api(
     select_string=None,
     event_id=None,
     asynchronous=False,
+    cache=True,
+    refresh=False,
+    parallel=False,
+    fields=None,
 ):
-    """Call a Wild Apricot API endpoint and automatically page through results when filtering."""
+    """Call a Wild Apricot API endpoint and automatically page through results when filtering.
 
-    oauth_session = auth.get_oauth_session()
-    base_url = f"{auth.WA_API_PREFIX}/{category}"
+    When the response cache is enabled (see apicache.py), results are served from
+    it unless cache=False. refresh=True skips the cached copy but stores the new one.
+    parallel=True fetches the pages of large collections concurrently (see _iter_responses).
+    fields is a list of record keys the caller needs: they are requested with
+    $select where the category supports it, every record is checked to have
+    them, and all other keys are dropped.
+    """
+
+    if cache and apicache.get_cache() is not None:
+        key = apicache.make_key(category, filter_string, select_string, event_id, asynchronous, fields)
+        if not refresh:
+            data = apicache.get(category, key)
+            if data is not None:
+                return data
+        data = call_api(category, filter_string, select_string, event_id, asynchronous, cache=False,
+                        parallel=parallel, fields=fields)
+        apicache.put(category, key, data)
+        return data
+
+    pages = _iter_responses(category, filter_string, select_string, event_id, asynchronous, parallel, fields)
+
+    return _assemble(pages, paginated=bool(filter_string))
+
+
+def iter_api(
+    category,
+    filter_string=None,
+    select_string=None,
+    event_id=None,
+    asynchronous=False,
+    pages=False,
+    parallel=False,
+    fields=None,
+    refresh=False,
+):
+    """Yield records from a Wild Apricot API endpoint as each page arrives.
+
+    Records are the items of list responses (e.g. EventRegistrations) or of the
+    collection inside object responses (e.g. each contact in {'Contacts': [...]}).
+    Any other response is yielded whole, once. With pages=True, each page's list
+    of records is yielded instead of individual records. parallel=True fetches
+    pages concurrently but still yields them in order. fields projects records
+    as in call_api.
+
+    A cached copy is used if the response cache has one, unless refresh=True;
+    streamed results are not added to the cache.
+    """
+    if apicache.get_cache() is not None and not refresh:
+        key = apicache.make_key(category, filter_string, select_string, event_id, asynchronous, fields)
+        data = apicache.get(category, key)
+        if data is not None:
+            responses = iter([data])
+        else:
+            responses = _iter_responses(category, filter_string, select_string, event_id, asynchronous,
+                                        parallel, fields)
+    else:
+        responses = _iter_responses(category, filter_string, select_string, event_id, asynchronous,
+                                    parallel, fields)
+
+    for data in responses:
+        items = _page_items(data)
+        if items is None:
+            yield data
+        elif pages:
+            yield items
+        else:
+            yield from items
+
+
+def _assemble(pages, paginated):
+    """Combine the responses from _iter_responses into the single result call_api returns."""
+    if not paginated:
+        data = next(pages)
+        logger.debug("API call successful (no pagination), returning data.")
+        logger.debug("*************************************")
+        logger.debug("%s", metrics.lazy_json(data))
+        return data
+
+    accumulated_list = None
+    accumulated_object = None
+    collection_key = None
 
+    for data in pages:
+        # Handle endpoints that return a raw list (e.g., EventRegistrations)
+        if isinstance(data, list):
+            if accumulated_list is None:
+                accumulated_list = []
+            accumulated_list.extend(data)
+            continue
+
+        # Handle endpoints that return an object containing the collection (e.g., {'Contacts': [...], 'Count': N})
+        if isinstance(data, dict):
+            if collection_key is None:
+                collection_key = _collection_key(data)
+                if collection_key is None:
+                    # Not a paginated collection response; just return the object
+                    logger.debug("API call successful (non-collection object), returning data.")
+                    logger.debug("*************************************")
+                    logger.debug("%s", metrics.lazy_json(data))
+                    return data
+                accumulated_object = dict(data)
+                accumulated_object[collection_key] = []
+
+            accumulated_object[collection_key].extend(data.get(collection_key, []))
+            continue
+
+        # Fallback: unknown response type; return as-is
+        logger.debug("API call successful (unknown type), returning data.")
+        logger.debug("*************************************")
+        logger.debug("%s", metrics.lazy_json(data))
+        return data
+
+    if accumulated_object is not None:
+        # Completed pagination for object-with-collection response
+        # If a count field exists, align it with accumulated length
+        if 'Count' in accumulated_object and isinstance(accumulated_object['Count'], int):
+            accumulated_object['Count'] = len(accumulated_object[collection_key])
+        logger.debug("API call successful, returning accumulated object data.")
+        logger.debug("*************************************")
+        logger.debug("%s", metrics.lazy_json(accumulated_object))
+        return accumulated_object
+
+    # Completed pagination for list response
+    logger.debug("API call successful, returning accumulated list data.")
+    logger.debug("*************************************")
+    logger.debug("%s", metrics.lazy_json(accumulated_list))
+    return accumulated_list
+
+
+def _collection_key(data):
+    """Return the key of the collection in an object response, e.g. 'Contacts', or None."""
+    # The collection key is the only key whose value is a list
+    list_keys = [k for k, v in data.items() if isinstance(v, list)]
+    if len(list_keys) == 1:
+        return list_keys[0]
+    return None
+
+
+def _page_items(data):
+    """Return the records on a page, or None if the response is not a collection."""
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict):
+        collection_key = _collection_key(data)
+        if collection_key is not None:
+            return data[collection_key]
+    return None
+
+
+def _base_params(filter_string, select_string, event_id, asynchronous):
     base_params = []
 
     if not asynchronous:
@@ -32,117 +210,235 @@ def call_api(
         base_params.append(("$select", select_string))
     if event_id:
         base_params.append(("eventId", str(event_id)))
+    return base_params
+
+
+def _iter_responses(category, filter_string, select_string, event_id, asynchronous, parallel=False,
+                    fields=None):
+    """Yield decoded API responses one page at a time, projected to fields if given."""
+    if fields:
+        select_string = select_string or select_string_for(category, fields)
+    responses = _fetch_responses(category, filter_string, select_string, event_id, asynchronous, parallel)
+    if not fields:
+        return responses
+    return (project(data, category, fields) for data in responses)
+
+
+def select_string_for(category, fields):
+    """Build the $select value for fields, or None if the category has no $select support."""
+    names = SELECT_FIELD_NAMES.get(category, {})
+    selected = [names[field] for field in fields if field in names]
+    if not selected:
+        return None
+    return ",".join(f"'{name}'" for name in selected)
+
+
+def project(data, category, fields):
+    """Reduce every record in a response to fields (plus Id), raising if any record lacks one of them."""
+    items = _page_items(data)
+    if items is None:
+        return data
+    keep = set(fields) | {'Id'}
+    projected = []
+    for item in items:
+        missing = [field for field in fields if field not in item]
+        if missing:
+            raise Exception(f"API response for {category} is missing expected fields: {', '.join(missing)}")
+        projected.append({key: value for key, value in item.items() if key in keep})
+    if isinstance(data, list):
+        return projected
+    data = dict(data)
+    data[_collection_key(data)] = projected
+    return data
+
+
+def _fetch_responses(category, filter_string, select_string, event_id, asynchronous, parallel=False):
+    """Yield decoded API responses one page at a time.
+
+    Unfiltered calls are a single request. Filtered calls page through with
+    $top/$skip until a short page, or a response that is not a collection.
+
+    With parallel=True, the total size is taken from the first page's Count (or
+    a $count probe) and the remaining pages are fetched concurrently, then
+    yielded in order. Records can shift between pages while we fetch, so
+    records already seen are dropped by Id, and paging continues sequentially
+    if the collection grew.
+    """
+    stats = metrics.CallStats(category)
+    try:
+        yield from _fetch_pages(category, filter_string, select_string, event_id, asynchronous, parallel, stats)
+    finally:
+        stats.record()
+
+
+def _fetch_pages(category, filter_string, select_string, event_id, asynchronous, parallel, stats):
+    oauth_session = auth.get_oauth_session()
+    base_url = f"{auth.WA_API_PREFIX}/{category}"
+    base_params = _base_params(filter_string, select_string, event_id, asynchronous)
 
     logger.debug(f"API url will be: {base_url}")
     logger.debug(f"API parameters will be: {base_params}")
 
     def perform_request(params):
         nonlocal oauth_session
-        request = oauth_session.get(url=base_url, params=params)
+        # The session is shared, and other threads may swap its token at any
+        # time, so note the token each request was actually sent with
+        sent_token = None
+
+        def send():
+            nonlocal sent_token
+            sent_token = oauth_session.access_token
+            return oauth_session.get(url=base_url, params=params)
+
+        # All calls go through the shared rate limiter, which also retries 429s
+        request = ratelimit.send(send, stats)
         if request.status_code == 401:
             logger.debug(
                 "API call failed with 401, refreshing token and trying again"
             )
-            auth.refresh_token()
+            # Another thread may already have replaced the token; only refresh if not
+            stats.add("token_refreshes")
+            auth.refresh_token(stale_token=sent_token)
             oauth_session = auth.get_oauth_session()
-            request = oauth_session.get(url=base_url, params=params)
-        elif request.status_code == 429:
-            logger.debug(
-                "API call failed with 429, sleeping for 10 seconds and trying again"
-            )
-            sleep(10)
-            request = oauth_session.get(url=base_url, params=params)
-        return request
-
-    if not filter_string:
-        request = perform_request(base_params)
+            request = ratelimit.send(send, stats)
         if request.status_code != 200:
             raise Exception(
                 f"API call failed with {request.status_code} {request.text}"
             )
-        data = request.json()
-        logger.debug("API call successful (no pagination), returning data.")
-        logger.debug("*************************************")
-        logger.debug(f"{json.dumps(data, indent=4)}")
-        return data
+        stats.add("pages")
+        stats.add("bytes", len(request.content))
+        progress.page_fetched()
+        return request.json()
 
-    skip = 0
-    accumulated_list = []
-    accumulated_object = None
-    collection_key = None
+    if not filter_string:
+        yield perform_request(base_params)
+        return
 
-    while True:
+    def page_params(skip):
         params = list(base_params)
         params.append(("$top", str(PAGE_SIZE)))
         params.append(("$skip", str(skip)))
+        return params
 
-        request = perform_request(params)
+    skip = 0
+    seen_ids = set() if parallel else None
 
-        if request.status_code != 200:
-            raise Exception(
-                f"API call failed with {request.status_code} {request.text}"
-            )
+    data = perform_request(page_params(skip))
+    items = _page_items(data)
 
-        data = request.json()
+    if parallel and items is not None and len(items) == PAGE_SIZE:
+        total = _total_count(data, lambda: perform_request(base_params + [("$count", "true")]))
+        if total is not None:
+            logger.debug(f"Fetching {total} {category} records in parallel pages.")
+            yield _drop_seen(data, seen_ids)
+            skips = list(range(PAGE_SIZE, total, PAGE_SIZE))
+            if not skips:
+                skip += PAGE_SIZE
+            else:
+                with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(skips))) as pool:
+                    def submit(page_skip):
+                        # Each page runs in a copy of our context so metrics keep the report tag
+                        return page_skip, pool.submit(contextvars.copy_context().run, perform_request,
+                                                      page_params(page_skip))
 
-        # Handle endpoints that return a raw list (e.g., EventRegistrations)
-        if isinstance(data, list):
-            accumulated_list.extend(data)
-            logger.debug(f"Retrieved {len(data)} records (skip={skip}).")
-            if len(data) < PAGE_SIZE:
-                # Completed pagination for list response
-                logger.debug("API call successful, returning accumulated list data.")
-                logger.debug("*************************************")
-                logger.debug(f"{json.dumps(accumulated_list, indent=4)}")
-                return accumulated_list
-            skip += PAGE_SIZE
-            continue
+                    # Only MAX_WORKERS pages are fetched ahead of the caller, so
+                    # a slow consumer doesn't have every page held in memory
+                    remaining = iter(skips)
+                    in_flight = deque(submit(page_skip) for page_skip in islice(remaining, MAX_WORKERS))
+                    while in_flight:
+                        skip, future = in_flight.popleft()
+                        data = future.result()
+                        for page_skip in islice(remaining, 1):
+                            in_flight.append(submit(page_skip))
+                        items = _page_items(data)
+                        logger.debug(f"Retrieved {len(items)} records (skip={skip}).")
+                        yield _drop_seen(data, seen_ids)
+                if len(items) < PAGE_SIZE:
+                    return
+                skip += PAGE_SIZE
+            # The collection grew while we were fetching; pick up the rest in order
+            data = perform_request(page_params(skip))
+            items = _page_items(data)
 
-        # Handle endpoints that return an object containing the collection (e.g., {'Contacts': [...], 'Count': N})
-        if isinstance(data, dict):
-            if collection_key is None:
-                # Detect the collection key on the first page: the first key whose value is a list
-                list_keys = [k for k, v in data.items() if isinstance(v, list)]
-                if len(list_keys) == 1:
-                    collection_key = list_keys[0]
-                    accumulated_object = dict(data)
-                    accumulated_object[collection_key] = []
-                    logger.debug(f"Detected collection key for pagination: {collection_key}")
-                else:
-                    # Not a paginated collection response; just return the object
-                    logger.debug("API call successful (non-collection object), returning data.")
-                    logger.debug("*************************************")
-                    logger.debug(f"{json.dumps(data, indent=4)}")
-                    return data
+    while True:
+        if items is not None:
+            logger.debug(f"Retrieved {len(items)} records (skip={skip}).")
+        yield data if seen_ids is None else _drop_seen(data, seen_ids)
 
-            page_items = data.get(collection_key, [])
-            accumulated_object[collection_key].extend(page_items)
-            logger.debug(
-                f"Retrieved {len(page_items)} records for '{collection_key}' (skip={skip})."
-            )
+        if items is None or len(items) < PAGE_SIZE:
+            return
+        skip += PAGE_SIZE
+        data = perform_request(page_params(skip))
+        items = _page_items(data)
 
-            if len(page_items) < PAGE_SIZE:
-                # Completed pagination for object-with-collection response
-                # If a count field exists, align it with accumulated length
-                if 'Count' in accumulated_object and isinstance(accumulated_object['Count'], int):
-                    accumulated_object['Count'] = len(accumulated_object[collection_key])
-                logger.debug("API call successful, returning accumulated object data.")
-                logger.debug("*************************************")
-                logger.debug(f"{json.dumps(accumulated_object, indent=4)}")
-                return accumulated_object
-
-            skip += PAGE_SIZE
-            continue
 
-        # Fallback: unknown response type; return as-is
-        logger.debug("API call successful (unknown type), returning data.")
-        logger.debug("*************************************")
-        logger.debug(f"{json.dumps(data, indent=4)}")
+def _total_count(data, probe):
+    """Return the collection size from a page's Count, or by calling probe for a $count response."""
+    if isinstance(data, dict) and isinstance(data.get('Count'), int) and data['Count'] > PAGE_SIZE:
+        return data['Count']
+    try:
+        counted = probe()
+    except Exception as e:
+        logger.debug(f"Count probe failed, paging sequentially: {e}")
+        return None
+    if isinstance(counted, dict) and isinstance(counted.get('Count'), int):
+        return counted['Count']
+    return None
+
+
+def _drop_seen(data, seen_ids):
+    """Return the page without records whose Id is already in seen_ids, and remember the new ones."""
+    items = _page_items(data)
+    if items is None:
         return data
+    fresh = []
+    for item in items:
+        item_id = item.get('Id') if isinstance(item, dict) else None
+        if item_id is not None:
+            if item_id in seen_ids:
+                continue
+            seen_ids.add(item_id)
+        fresh.append(item)
+    if isinstance(data, list):
+        return fresh
+    data = dict(data)
+    data[_collection_key(data)] = fresh
+    return data
 
-    # We should never reach here because returns happen inside the loop
-    # but keep a defensive return in case of logic changes.
-    logger.debug("API pagination loop ended unexpectedly; returning best-effort data.")
-    if accumulated_object is not None:
-        return accumulated_object
-    return accumulated_list
+
+def call_api_many(category, event_ids, max_workers=None, decode=None, **kwargs):
+    """Call the same endpoint once per event id using a bounded pool of worker threads.
+
+    Results are returned as a list in the same order as event_ids. Any exception
+    raised by an individual call is re-raised here. decode, if given, is
+    applied to each result as it arrives (e.g. records.registrations), so the
+    raw responses don't all have to be held at once. With WA_API_ASYNC set, the
+    calls run as coroutines on the async client instead.
+    """
+    event_ids = list(event_ids)
+    if USE_ASYNC:
+        # Imported here because wadata_async builds on this module
+        import wadata_async
+        return wadata_async.call_api_many_sync(category, event_ids, max_workers=max_workers, decode=decode,
+                                                  **kwargs)
+
+    if max_workers is None:
+        max_workers = MAX_WORKERS
+    max_workers = max(1, min(max_workers, len(event_ids)))
+
+    def fetch(event_id):
+        data = call_api(category, event_id=event_id, **kwargs)
+        if decode is not None:
+            data = decode(data)
+        progress.advance()
+        return data
+
+    logger.debug(f"Fetching {category} for {len(event_ids)} events with {max_workers} workers.")
+
+    if max_workers == 1:
+        return [fetch(event_id) for event_id in event_ids]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # Each call runs in a copy of our context so metrics keep the report tag
+        futures = [pool.submit(contextvars.copy_context().run, fetch, event_id) for event_id in event_ids]
+        return [future.result() for future in futures]
@@ -0,0 +1,162 @@
+import auth
+import apicache
+import metrics
+import progress
+import ratelimit
+import wadata
+import os
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# An asyncio counterpart to wadata.call_api. Requests are cheap coroutines on
+# one event loop instead of a thread each, so large fan-outs (registrations
+# for hundreds of events) can have many calls in flight. Pacing still comes
+# from the shared rate limiter; this only caps how many coroutines wait on it.
+MAX_CONCURRENCY = int(os.environ.get("WA_API_ASYNC_CONCURRENCY", 50))
+
+
+@asynccontextmanager
+async def api_client():
+    """An httpx client with keep-alive connections to the API, sized for MAX_CONCURRENCY."""
+    limits = httpx.Limits(max_connections=auth.WA_API_POOL_SIZE,
+                          max_keepalive_connections=auth.WA_API_POOL_SIZE)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        yield client
+
+
+async def call_api(
+    category,
+    filter_string=None,
+    select_string=None,
+    event_id=None,
+    asynchronous=False,
+    cache=True,
+    refresh=False,
+    fields=None,
+    client=None,
+):
+    """Async version of wadata.call_api, with the same parameters and results.
+
+    Pass an httpx.AsyncClient from api_client() to share connections between calls.
+    """
+    if client is None:
+        async with api_client() as client:
+            return await call_api(category, filter_string, select_string, event_id, asynchronous,
+                                  cache=cache, refresh=refresh, fields=fields, client=client)
+
+    if cache and apicache.get_cache() is not None:
+        key = apicache.make_key(category, filter_string, select_string, event_id, asynchronous, fields)
+        # The cache may be SQLite, and decoding entries is CPU work; keep both off the event loop
+        if not refresh:
+            data = await asyncio.to_thread(apicache.get, category, key)
+            if data is not None:
+                return data
+        data = await call_api(category, filter_string, select_string, event_id, asynchronous,
+                              cache=False, fields=fields, client=client)
+        await asyncio.to_thread(apicache.put, category, key, data)
+        return data
+
+    if fields:
+        select_string = select_string or wadata.select_string_for(category, fields)
+    # Project each page as it arrives so full records are not all held at once
+    pages = [wadata.project(page, category, fields) if fields else page
+             async for page in _iter_responses(client, category, filter_string, select_string,
+                                               event_id, asynchronous)]
+    return wadata._assemble(iter(pages), paginated=bool(filter_string))
+
+
+async def call_api_many(category, event_ids, max_workers=None, client=None, decode=None, **kwargs):
+    """Async version of wadata.call_api_many: one call per event id, results in event order.
+
+    At most max_workers calls (default MAX_CONCURRENCY) are in flight at once.
+    """
+    if client is None:
+        async with api_client() as client:
+            return await call_api_many(category, event_ids, max_workers=max_workers, client=client,
+                                       decode=decode, **kwargs)
+
+    semaphore = asyncio.Semaphore(max(1, max_workers or MAX_CONCURRENCY))
+
+    async def fetch(event_id):
+        async with semaphore:
+            data = await call_api(category, event_id=event_id, client=client, **kwargs)
+        if decode is not None:
+            data = decode(data)
+        progress.advance()
+        return data
+
+    return await asyncio.gather(*(fetch(event_id) for event_id in event_ids))
+
+
+async def _iter_responses(client, category, filter_string, select_string, event_id, asynchronous):
+    """Async version of wadata._iter_responses (sequential paging)."""
+    stats = metrics.CallStats(category)
+    try:
+        async for data in _fetch_pages(client, category, filter_string, select_string, event_id, asynchronous,
+                                       stats):
+            yield data
+    finally:
+        stats.record()
+
+
+async def _fetch_pages(client, category, filter_string, select_string, event_id, asynchronous, stats):
+    base_url = f"{auth.WA_API_PREFIX}/{category}"
+    base_params = wadata._base_params(filter_string, select_string, event_id, asynchronous)
+    # Token refreshes are blocking and single-flight; keep them off the event loop
+    token = await asyncio.to_thread(auth.get_api_token)
+
+    async def perform_request(params):
+        nonlocal token
+
+        def send():
+            return client.get(base_url, params=params, headers={"Authorization": f"Bearer {token}"})
+
+        response = await ratelimit.send_async(send, stats)
+        if response.status_code == 401:
+            logger.debug("API call failed with 401, refreshing token and trying again")
+            stats.add("token_refreshes")
+            await asyncio.to_thread(auth.refresh_token, stale_token=token)
+            token = await asyncio.to_thread(auth.get_api_token)
+            response = await ratelimit.send_async(send, stats)
+        if response.status_code != 200:
+            raise Exception(f"API call failed with {response.status_code} {response.text}")
+        stats.add("pages")
+        stats.add("bytes", len(response.content))
+        progress.page_fetched()
+        return response.json()
+
+    if not filter_string:
+        yield await perform_request(base_params)
+        return
+
+    skip = 0
+    while True:
+        params = list(base_params)
+        params.append(("$top", str(wadata.PAGE_SIZE)))
+        params.append(("$skip", str(skip)))
+
+        data = await perform_request(params)
+        items = wadata._page_items(data)
+        if items is not None:
+            logger.debug(f"Retrieved {len(items)} records (skip={skip}).")
+        yield data
+
+        if items is None or len(items) < wadata.PAGE_SIZE:
+            return
+        skip += wadata.PAGE_SIZE
+
+
+# Sync shims so code running on executor threads (the reports) can use the
+# async client. Each call runs its own event loop.
+
+def call_api_sync(category, **kwargs):
+    return asyncio.run(call_api(category, **kwargs))
+
+
+def call_api_many_sync(category, event_ids, **kwargs):
+    return asyncio.run(call_api_many(category, list(event_ids), **kwargs))
@@ -5,27 +5,81 @@ from dotenv import load_dotenv
 load_dotenv() 
 
 from flask import Flask
-from flask_executor import Executor
 from reports import reports_blueprint
+import auth
 from auth import auth_blueprint
+from metrics import metrics_blueprint
+import mirror
+import scheduler
 import logging
 import os
 
 logger = logging.getLogger(__name__)
 
-# This code sets up the flask application and registers the auth and reports
-# blueprints. It also sets a secret key which is used to sign session cookies
-# and other things. The secret key is stored in the environment variable
-# WA_REPORTING_FLASK_SECRET_KEY
-app = Flask(__name__)
-app.register_blueprint(auth_blueprint)
-app.register_blueprint(reports_blueprint, url_prefix='/reports')
-app.secret_key = os.environ['WA_REPORTING_FLASK_SECRET_KEY']
-
-# flask_executor plugin configuration
-app.config['EXECUTOR_TYPE'] = 'thread'
-app.config['ALLOW_LOCALHOST'] = False
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1000 * 1000 # 16 MB max file upload size
+
+def create_app(config=None):
+    """Build the flask application; config overrides the settings below.
+
+    This only builds the app: nothing here opens a database, starts a thread
+    or imports pandas. Executor pools and local stores are created on first
+    use, in the process that uses them, so the app is safe to build in a
+    gunicorn --preload parent and fork (`gunicorn --preload wareporting:app`).
+    """
+    # This code sets up the flask application and registers the auth and reports
+    # blueprints. It also sets a secret key which is used to sign session cookies
+    # and other things. The secret key is stored in the environment variable
+    # WA_REPORTING_FLASK_SECRET_KEY
+    app = Flask(__name__)
+    app.register_blueprint(auth_blueprint)
+    app.register_blueprint(reports_blueprint, url_prefix='/reports')
+    app.register_blueprint(metrics_blueprint)
+    app.secret_key = os.environ['WA_REPORTING_FLASK_SECRET_KEY']
+
+    # `flask --app wareporting mirror-sync` refreshes the local Wild Apricot mirror
+    app.cli.add_command(mirror.sync_command)
+    # `flask --app wareporting access-invalidate [CONTACT_ID]` forgets cached report access
+    app.cli.add_command(auth.invalidate_access_command)
+    # `flask --app wareporting prewarm [NAME...]` pre-warms reports right away
+    app.cli.add_command(scheduler.prewarm_command)
+
+    # flask_executor pools (see reports.REPORT_POOLS). Long API fan-outs run in
+    # "reports", short reports in "quick" so they don't wait behind them, and
+    # CPU-bound pandas work in the "cpu" process pool, away from the GIL.
+    app.config['REPORTS_EXECUTOR_TYPE'] = 'thread'
+    app.config['REPORTS_EXECUTOR_MAX_WORKERS'] = int(os.environ.get('WA_REPORTING_REPORT_WORKERS', 4))
+    app.config['QUICK_EXECUTOR_TYPE'] = 'thread'
+    app.config['QUICK_EXECUTOR_MAX_WORKERS'] = int(os.environ.get('WA_REPORTING_QUICK_WORKERS', 4))
+    app.config['CPU_EXECUTOR_TYPE'] = os.environ.get('WA_REPORTING_CPU_EXECUTOR', 'process')
+    app.config['CPU_EXECUTOR_MAX_WORKERS'] = int(os.environ.get('WA_REPORTING_CPU_WORKERS', 2))
+    app.config['ALLOW_LOCALHOST'] = False
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1000 * 1000 # 16 MB max file upload size
+
+    # Identical report requests share one run; a finished result is reused for
+    # this many seconds, and kept for collection for REPORT_RESULT_KEEP_SECONDS
+    app.config['REPORT_REUSE_SECONDS'] = int(os.environ.get('WA_REPORTING_REPORT_REUSE_SECONDS', 300))
+    app.config['REPORT_RESULT_KEEP_SECONDS'] = 3600
+    # Report results are kept in the job store compressed; refuse any single result
+    # bigger than this, and evict the oldest once they add up to the store limit
+    app.config['REPORT_RESULT_MAX_BYTES'] = 10 * 1000 * 1000
+    app.config['REPORT_RESULT_STORE_MAX_BYTES'] = 200 * 1000 * 1000
+    # Reports computed ahead of time, {report name: cron expression} (see
+    # scheduler.py), and how long their results are served before going cold
+    app.config['PREWARM_SCHEDULE'] = scheduler.parse_schedule(os.environ.get(
+        'WA_REPORTING_PREWARM', 'missing_instructor_checkins=0 6 * * *; makerschool_registrations=0 6 * * *'))
+    app.config['PREWARM_MAX_AGE_SECONDS'] = int(os.environ.get('WA_REPORTING_PREWARM_MAX_AGE', 24 * 3600))
+
+    if config:
+        app.config.update(config)
+    scheduler.init_app(app)
+
+    missing = auth.missing_settings()
+    if missing:
+        logger.warning(f"Missing environment variables {', '.join(missing)}; login and API calls will fail.")
+    return app
+
+
+# The WSGI app, `wareporting:app`
+app = create_app()
 
 if __name__ == "__main__":
     # This code will only run if you run this file directly. It will not run